@@ -1,13 +1,48 @@
 import os
+import sys
+import argparse
 from enums import *
-from license_analysis import perform_license_analysis
-from components_analysis import perform_components_analysis
-from fill_forms import fill_black_duck_form
+from config import ConfigError, load_config
+
+# the heavy modules (pandas, openpyxl, requests, tqdm) are imported only by the subcommand that uses
+# them: `fill` and `--help` do not pay for the analyses
 
 SCAN_COMPONENTS: bool = bool(os.getenv('SCAN_COMPONENTS', False))
 SCAN_LICENSES: bool = bool(os.getenv('SCAN_LICENSES', False))
+# licenses, components and custom fields in a single run, downloading each BOM once
+PIPELINE: bool = bool(os.getenv('PIPELINE', False))
+# same as PIPELINE with asyncio: download, analysis, writing and fill of different modules overlap
+ASYNC_PIPELINE: bool = bool(os.getenv('ASYNC_PIPELINE', False))
+# json file with modules, form values and scan infos (see config.py), replacing the ones below
+CONFIG: str = os.getenv('CONFIG', '')
+# on-disk cache of the BOM reused across runs for BOM_CACHE_TTL seconds (PIPELINE alone revalidates it at every run)
+BOM_CACHE: bool = bool(os.getenv('BOM_CACHE', False))
+BOM_CACHE_TTL: float = float(os.getenv('BOM_CACHE_TTL', 24 * 60 * 60))
+BOM_CACHE_REVALIDATE: bool = bool(os.getenv('BOM_CACHE_REVALIDATE', False))
+# remember the custom fields written in oss/state.sqlite and do not fill them again
+INCREMENTAL: bool = bool(os.getenv('INCREMENTAL', False))
 BEARER_TOKEN: str = os.getenv('BEARER_TOKEN', '')
-HEADERS = {"Authorization": "Bearer " + BEARER_TOKEN}
+# licenses_to_check written as newline-delimited json (licenses_to_check.ndjson), one line per license
+LICENSES_NDJSON: bool = bool(os.getenv('LICENSES_NDJSON', False))
+# processes analyzing the modules at the same time (1 = one module after the other)
+ANALYSIS_WORKERS: int = int(os.getenv('ANALYSIS_WORKERS', 1))
+# concurrent PUT requests and max PUT per second while filling custom fields
+FILL_WORKERS: int = int(os.getenv('FILL_WORKERS', 8))
+FILL_RATE: float = float(os.getenv('FILL_RATE', 2.0))
+# read the current custom fields first and write only the components with a value that differs
+FILL_DIFF: bool = bool(os.getenv('FILL_DIFF', False))
+# checkpoint of the fill in oss/fill_journal_<modules>.jsonl: an interrupted fill resumes where it stopped (FILL_JOURNAL=0 disables it)
+FILL_JOURNAL: bool = os.getenv('FILL_JOURNAL', '1') != '0'
+# fill only the writes failed in the last fill of the same modules, saved in oss/fill_retry_<modules>.json
+FILL_RETRY: bool = bool(os.getenv('FILL_RETRY', False))
+# HTTP client: connections kept alive, timeout (seconds) and retries on 429/5xx
+HTTP_POOL_SIZE: int = int(os.getenv('HTTP_POOL_SIZE', max(10, FILL_WORKERS)))
+HTTP_TIMEOUT: float = float(os.getenv('HTTP_TIMEOUT', 120))
+HTTP_RETRIES: int = int(os.getenv('HTTP_RETRIES', 5))
+# file where the metrics of the run are saved: Prometheus textfile if it ends with .prom, JSON otherwise
+METRICS_REPORT: str = os.getenv('METRICS_REPORT', '')
+# file where the cProfile stats of the run are saved (read them with pstats or snakeviz)
+PROFILE: str = os.getenv('PROFILE', '')
 FORM_VALUE = {
     "22": Obligation.AGREE,
     "17": DistributionType.INTERNAL,
@@ -20,7 +55,7 @@ SCAN_INFOS = {
     "Internal" : True,
     "Modification" : False,
     "Hosted" : True,
-    "Host_control_ABB" : True, 
+    "Host_control_ABB" : True,
     # type of interaction is easy to get from blackduck
 }
 # dev version for all modules
@@ -30,15 +65,171 @@ MODULES = {
         "versionId": ""
     }
 }
+COMMANDS = ("licenses", "components", "fill", "pipeline")
 
-if __name__ == "__main__":
+
+def get_env_command() -> str:
+    """Subcommand of a run without one, chosen by the environment variables."""
+    if PIPELINE or ASYNC_PIPELINE:
+        return "pipeline"
     if SCAN_COMPONENTS:
-        print("Analyzing components...")
-        perform_components_analysis(MODULES, HEADERS, SCAN_INFOS)
+        return "components"
+    if SCAN_LICENSES:
+        return "licenses"
+    return "fill"
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Every option defaults to its environment variable."""
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--config', default=CONFIG,
+                        help="json file with modules, form_values and scan_infos (default: the values in __main__.py)")
+    common.add_argument('--http-pool-size', type=int, default=HTTP_POOL_SIZE)
+    common.add_argument('--http-timeout', type=float, default=HTTP_TIMEOUT, help="read timeout in seconds")
+    common.add_argument('--http-retries', type=int, default=HTTP_RETRIES)
+    common.add_argument('--metrics-report', default=METRICS_REPORT,
+                        help="file where the metrics are saved (Prometheus textfile if it ends with .prom)")
+    common.add_argument('--profile', default=PROFILE, help="file where the cProfile stats are saved")
+    common.add_argument('--bom-cache', action='store_true', default=BOM_CACHE,
+                        help="reuse the BOM saved in oss/.bom_cache")
+    common.add_argument('--bom-cache-ttl', type=float, default=BOM_CACHE_TTL)
+    common.add_argument('--bom-cache-revalidate', action='store_true', default=BOM_CACHE_REVALIDATE)
+
+    incremental = argparse.ArgumentParser(add_help=False)
+    incremental.add_argument('--incremental', action='store_true', default=INCREMENTAL,
+                             help="remember the custom fields written in oss/state.sqlite and skip the components already filled")
+
+    analysis = argparse.ArgumentParser(add_help=False)
+    analysis.add_argument('--workers', type=int, default=ANALYSIS_WORKERS,
+                          help="processes analyzing the modules at the same time")
+
+    licenses = argparse.ArgumentParser(add_help=False)
+    licenses.add_argument('--ndjson', action='store_true', default=LICENSES_NDJSON,
+                          help="write oss/licenses_to_check.ndjson instead of the json file")
+
+    fill = argparse.ArgumentParser(add_help=False)
+    fill.add_argument('--fill-workers', type=int, default=FILL_WORKERS, help="concurrent PUT requests")
+    fill.add_argument('--fill-rate', type=float, default=FILL_RATE, help="max requests per second, 0 = no limit")
+    fill.add_argument('--diff', action='store_true', default=FILL_DIFF, help="write only the components with a field that differs")
+    fill.add_argument('--no-journal', dest='journal', action='store_false', default=FILL_JOURNAL,
+                      help="do not checkpoint the fill in oss/fill_journal_<modules>.jsonl")
+
+    parser = argparse.ArgumentParser(prog="oss", description="Black Duck licenses analysis and custom fields fill. "
+                                     "Without a command, the one chosen by the environment variables is run.")
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.add_parser('licenses', parents=[common, analysis, licenses],
+                          help="write the licenses of the modules and their rule set")
+    subparsers.add_parser('components', parents=[common, analysis],
+                          help="write the components of the modules and their decision")
+    fill_parser = subparsers.add_parser('fill', parents=[common, incremental, fill], help="fill the custom fields")
+    fill_parser.add_argument('--retry', action='store_true', default=FILL_RETRY,
+                             help="fill only the writes failed in the last fill of the same modules (oss/fill_retry_<modules>.json)")
+    pipeline_parser = subparsers.add_parser('pipeline', parents=[common, incremental, analysis, licenses, fill],
+                                            help="licenses, components and fill in a single run")
+    pipeline_parser.add_argument('--async', dest='use_async', action='store_true', default=ASYNC_PIPELINE,
+                                 help="overlap download, analysis and fill with asyncio (needs httpx)")
+    return parser
+
+
+def get_bom_cache(args):
+    if not args.bom_cache:
+        return None
+    from bom_cache import BomCache
+    return BomCache(ttl=args.bom_cache_ttl, revalidate=args.bom_cache_revalidate)
+
+
+def get_state(args):
+    if not args.incremental:
+        return None
+    from state_store import StateStore
+    return StateStore()
+
+
+def get_journal(args, config: dict):
+    if not args.journal:
+        return None
+    from fill_journal import FillJournal
+    return FillJournal(config["form_values"], config["modules"])
+
+
+def run_licenses(args, config: dict, headers: dict):
+    from license_analysis import perform_license_analysis
+    print("Analyzing licenses...")
+    perform_license_analysis(config["modules"], headers, get_bom_cache(args), args.workers, args.ndjson)
+
+
+def run_components(args, config: dict, headers: dict):
+    from components_analysis import perform_components_analysis
+    print("Analyzing components...")
+    perform_components_analysis(config["modules"], headers, config["scan_infos"], get_bom_cache(args), args.workers)
+
+
+def run_fill(args, config: dict, headers: dict):
+    from fill_forms import fill_black_duck_form, retry_failed_fills
+    fill_options = dict(max_workers=args.fill_workers, rate=args.fill_rate, state=get_state(args), diff=args.diff)
+    if args.retry:
+        print("Filling the custom fields failed in the last fill...")
+        retry_failed_fills(config["modules"], headers, config["form_values"], journal=args.journal, **fill_options)
     else:
-        if SCAN_LICENSES:
-            print("Analyzing licenses...")
-            perform_license_analysis(MODULES, HEADERS)
-        else:
-            print("Filling custom fields...")
-            fill_black_duck_form(MODULES, HEADERS, FORM_VALUE)
+        print("Filling custom fields...")
+        fill_black_duck_form(config["modules"], headers, config["form_values"], bom_cache=get_bom_cache(args),
+                             journal=get_journal(args, config), **fill_options)
+
+
+def run_pipeline(args, config: dict, headers: dict):
+    fill_options = dict(max_workers=args.fill_workers, rate=args.fill_rate, diff=args.diff,
+                        journal=get_journal(args, config))
+    if args.use_async:
+        # httpx is needed only by this mode
+        from async_pipeline import run_async_pipeline
+        run_async_pipeline(config["modules"], headers, config["scan_infos"], config["form_values"], args.workers,
+                           get_state(args), args.ndjson, **fill_options)
+    else:
+        import pipeline
+        # without --bom-cache the pipeline keeps the BOM only for this run
+        pipeline.run_pipeline(config["modules"], headers, config["scan_infos"], config["form_values"],
+                              get_bom_cache(args), args.workers, get_state(args), args.ndjson, **fill_options)
+
+
+COMMAND_FUNCTIONS = {
+    "licenses": run_licenses,
+    "components": run_components,
+    "fill": run_fill,
+    "pipeline": run_pipeline
+}
+
+
+def main(argv: list = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS + ('-h', '--help'):
+        argv = [get_env_command()] + argv
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    config = {"modules": MODULES, "form_values": FORM_VALUE, "scan_infos": SCAN_INFOS}
+    if args.config:
+        try:
+            config.update(load_config(args.config))
+        except ConfigError as e:
+            parser.error(str(e))
+    headers = {"Authorization": "Bearer " + BEARER_TOKEN}
+
+    profile = None
+    if args.profile:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        from black_duck_api import configure_client
+        configure_client(pool_size=args.http_pool_size, timeout=(10, args.http_timeout), max_retries=args.http_retries)
+        COMMAND_FUNCTIONS[args.command](args, config, headers)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(args.profile)
+        if args.metrics_report:
+            from metrics import get_metrics
+            get_metrics().write_report(args.metrics_report)
+
+
+if __name__ == "__main__":
+    main()
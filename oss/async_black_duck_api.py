@@ -0,0 +1,141 @@
+import json
+import time
+import asyncio
+import httpx
+from black_duck_api import (BASE_URL, QUERY_PARAMS, PAGE_SIZE, POOL_SIZE, TIMEOUT, MAX_RETRIES, BACKOFF_FACTOR,
+                            BlackDuckClient, BlackDuckError, RetryingClient, generate_payload)
+from metrics import get_metrics
+
+
+class AsyncRateLimiter:
+    """Token bucket shared by the tasks of an event loop: at most `rate` calls per second."""
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            # no limit
+            return
+        # one waiter at a time, so the tokens are given in the order of arrival
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class AsyncBlackDuckClient(RetryingClient):
+    """asyncio version of BlackDuckClient (httpx): keep-alive pool, timeouts, retries and an optional rate limit."""
+
+    def __init__(self, base_url: str = BASE_URL, pool_size: int = POOL_SIZE, timeout=TIMEOUT,
+                 max_retries: int = MAX_RETRIES, backoff_factor: float = BACKOFF_FACTOR,
+                 rate_limiter: AsyncRateLimiter = None):
+        super().__init__(base_url, pool_size, timeout, max_retries, backoff_factor)
+        self.rate_limiter = rate_limiter
+        connect_timeout, read_timeout = timeout
+        self.session = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+
+    @classmethod
+    def from_client(cls, client: BlackDuckClient, rate_limiter: AsyncRateLimiter = None) -> "AsyncBlackDuckClient":
+        """Same server, pool size, timeout and retries of a (configured) synchronous client."""
+        return cls(client.base_url, client.pool_size, client.timeout, client.max_retries, client.backoff_factor,
+                   rate_limiter)
+
+    async def request(self, method: str, api: str, **kwargs) -> httpx.Response:
+        url = self.get_url(api)
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                resp = await self.session.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                delay = self.get_error_delay(method, e, time.perf_counter() - start, attempt)
+                if delay is None:
+                    raise
+            else:
+                delay = self.get_response_delay(method, resp, len(resp.request.content),
+                                                time.perf_counter() - start, attempt)
+                if delay is None:
+                    return resp
+            await asyncio.sleep(delay)
+
+    async def get(self, api: str, **kwargs) -> httpx.Response:
+        return await self.request('GET', api, **kwargs)
+
+    async def put(self, api: str, **kwargs) -> httpx.Response:
+        return await self.request('PUT', api, **kwargs)
+
+    async def close(self):
+        await self.session.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+async def get_components_page(client: AsyncBlackDuckClient, api_headers: dict, project_id: str, version_id: str,
+                              offset: int, page_size: int = PAGE_SIZE) -> dict:
+    api = f'/api/projects/{project_id}/versions/{version_id}/components'
+    metrics = get_metrics()
+    with metrics.stage('fetch'):
+        resp = await client.get(api + QUERY_PARAMS.format(limit=page_size, offset=offset), headers=api_headers)
+    with metrics.stage('parse'):
+        page = json.loads(resp.content)
+    if 'errorMessage' in page:
+        raise BlackDuckError(page['errorMessage'])
+    metrics.add_rows('fetch', len(page.get('items', [])))
+    metrics.add_rows('parse', len(page.get('items', [])))
+    return page
+
+
+async def get_project_components(client: AsyncBlackDuckClient, api_headers: dict, project_id: str, version_id: str,
+                                 page_size: int = PAGE_SIZE) -> list:
+    """Components of a project version: after the first page, the other ones are requested concurrently."""
+    first_page = await get_components_page(client, api_headers, project_id, version_id, 0, page_size)
+    items = first_page.get('items', [])
+    total = first_page.get('totalCount', len(items))
+    pages = await asyncio.gather(*(
+        get_components_page(client, api_headers, project_id, version_id, offset, page_size)
+        for offset in range(len(items), total, page_size))) if items else []
+    for page in pages:
+        items.extend(page.get('items', []))
+    return items
+
+
+def get_custom_fields_api(project_id: str, project_version_id: str, component_id: str, component_version_id: str):
+    return f'/api/projects/{project_id}/versions/{project_version_id}/components/{component_id}/versions/{component_version_id}/custom-fields'
+
+
+async def get_black_duck_custom_fields(client: AsyncBlackDuckClient, api_headers: dict, project_id: str,
+                                       project_version_id: str, component_id: str, component_version_id: str):
+    headers = api_headers.copy()  # by value and not by reference
+    headers["Accept"] = "application/json"
+    api = get_custom_fields_api(project_id, project_version_id, component_id, component_version_id)
+    resp = await client.get(api, headers=headers)
+    return json.loads(resp.content)
+
+
+async def set_black_duck_custom_fields(client: AsyncBlackDuckClient, api_headers: dict, project_id: str,
+                                       project_version_id: str, component_id: str, component_version_id: str,
+                                       values: dict):
+    headers = api_headers.copy()  # by value and not by reference
+    headers["Content-type"] = "application/json"
+    headers["Accept"] = "application/json"
+    api = get_custom_fields_api(project_id, project_version_id, component_id, component_version_id)
+    payload = generate_payload(client.base_url + api, values, client.custom_field_value_url)
+    resp = await client.put(api, headers=headers, json=payload)
+    return json.loads(resp.content)
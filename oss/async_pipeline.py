@@ -0,0 +1,245 @@
+import asyncio
+from datetime import datetime
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import httpx
+from tqdm import tqdm
+from black_duck_api import BlackDuckError, get_client
+from async_black_duck_api import (AsyncBlackDuckClient, AsyncRateLimiter, get_project_components,
+                                  get_black_duck_custom_fields, set_black_duck_custom_fields)
+from fill_forms import (MAX_WORKERS, REQUESTS_PER_SECOND, BURST, FillRecorder, get_component_versions, get_diff_answer,
+                        get_error_answer)
+import license_analysis
+import components_analysis
+from licenses_file import LicensesAggregator
+from metrics import call_with_metrics, get_metrics
+from rules import load_rules
+from state_store import StateStore
+from fill_journal import FillJournal
+
+# modules waiting between two stages: when a stage is late, the previous ones stop instead of
+# keeping more BOM in memory
+QUEUE_SIZE = 2
+
+
+def analyze_module(components: list, branch_infos: dict):
+    """Licenses and components of a module.
+
+    The rule set of a license does not depend on the module, so the components get it from the
+    licenses of their own module instead of waiting for "All".
+    """
+    licenses = license_analysis.collect_licenses(components)
+    licenses_json = {license: {"rule_set": value.rule_set} for license, value in licenses.items()}
+    return licenses, components_analysis.collect_components(components, licenses_json, branch_infos)
+
+
+async def run_stages(*stages):
+    """Runs the stages together; the first error cancels the other ones, that could wait forever on a queue."""
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+class AsyncPipeline:
+    """Licenses, components and custom fields of all the modules in a single asyncio run.
+
+    The stages overlap, linked by bounded queues: the BOM of module N+1 is downloaded (its pages
+    concurrently) while module N is analyzed and the sheets of module N-1 are written. The custom
+    fields of a module are filled as soon as its BOM is downloaded. All the requests share the
+    rate limit, so the throughput is the one allowed by the server.
+    """
+
+    def __init__(self, modules: dict, headers: dict, branch_infos: dict, form_values: dict, workers: int = 1,
+                 state: StateStore = None, licenses_ndjson: bool = False, max_workers: int = MAX_WORKERS,
+                 rate: float = REQUESTS_PER_SECOND, diff: bool = False, journal: FillJournal = None,
+                 queue_size: int = QUEUE_SIZE):
+        self.modules = modules
+        self.headers = headers
+        self.branch_infos = branch_infos
+        self.form_values = form_values
+        self.workers = workers
+        self.state = state
+        self.licenses_ndjson = licenses_ndjson
+        self.max_workers = max_workers
+        self.rate = rate
+        self.diff = diff
+        self.queue_size = queue_size
+        self.recorder = FillRecorder(form_values, state, journal)
+        self.licenses_writer = license_analysis.get_writer()
+        self.components_writer = components_analysis.get_writer()
+        self.client = None
+        self.aggregator = None
+        self.progress_bars = []
+        # writes of the components in flight, cancelled before closing the client and the journal on an error
+        self.fill_tasks = set()
+
+    async def run(self):
+        if self.workers > 1:
+            # the workers read the Rules cache written here instead of building it all at the same time
+            load_rules()
+        rate_limiter = AsyncRateLimiter(self.rate, capacity=BURST)
+        self.client = AsyncBlackDuckClient.from_client(get_client(), rate_limiter)
+        analysis_queue = asyncio.Queue(self.queue_size)
+        write_queue = asyncio.Queue(self.queue_size)
+        fill_queue = asyncio.Queue(self.queue_size)
+        executor = ProcessPoolExecutor(self.workers) if self.workers > 1 else ThreadPoolExecutor(1)
+        try:
+            with LicensesAggregator(self.licenses_ndjson) as self.aggregator:
+                await run_stages(self.fetch(analysis_queue, fill_queue),
+                                 self.analyze(analysis_queue, write_queue, executor),
+                                 self.write(write_queue),
+                                 self.fill(fill_queue))
+                all_licenses = self.aggregator.get_all_licenses()
+                if all_licenses:
+                    license_analysis.save_into_excel("All", all_licenses, writer=self.licenses_writer)
+        except BaseException:
+            # the writes already sent are in the journal, the next run resumes the fill
+            self.recorder.mark_incomplete()
+            raise
+        finally:
+            for task in self.fill_tasks:
+                task.cancel()
+            await asyncio.gather(*self.fill_tasks, return_exceptions=True)
+            executor.shutdown()
+            await self.client.close()
+            for progress_bar in self.progress_bars:
+                progress_bar.close()
+            self.recorder.close(self.diff)
+        for writer in (self.licenses_writer, self.components_writer):
+            if writer.sheets:
+                writer.save()
+
+    async def fetch(self, analysis_queue: asyncio.Queue, fill_queue: asyncio.Queue):
+        try:
+            for module_name, module_info in self.modules.items():
+                try:
+                    components = await get_project_components(
+                        self.client, self.headers, module_info['id'], module_info['versionId'])
+                except (BlackDuckError, httpx.HTTPError, ValueError) as e:
+                    self.recorder.mark_incomplete()
+                    print(f"Error on get components for {module_name}: {e}")
+                    continue
+                # waits here when the analysis or the fill are late
+                await analysis_queue.put((module_name, components))
+                await fill_queue.put((module_name, components))
+        finally:
+            await analysis_queue.put(None)
+            await fill_queue.put(None)
+
+    async def analyze(self, analysis_queue: asyncio.Queue, write_queue: asyncio.Queue, executor):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                item = await analysis_queue.get()
+                if item is None:
+                    break
+                module_name, components = item
+                analysis = partial(analyze_module, components, self.branch_infos)
+                if self.workers > 1:
+                    # the metrics of the worker process come back with the result
+                    analysis = partial(call_with_metrics, analysis)
+                # the next module is sent to the executor while this one runs, up to queue_size modules
+                await write_queue.put((module_name, loop.run_in_executor(executor, analysis)))
+        finally:
+            await write_queue.put(None)
+
+    def write_module(self, module_name: str, licenses: dict, set_of_components: list):
+        license_analysis.save_into_excel(module_name, licenses, writer=self.licenses_writer)
+        self.aggregator.add_module(module_name, licenses)
+        components_analysis.save_into_excel(module_name, set_of_components, licenses_datetime=datetime.now(),
+                                            writer=self.components_writer)
+
+    async def write(self, write_queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        progress_bar = tqdm(
+            total=len(self.modules),
+            desc="Modules".ljust(15),
+            bar_format="{l_bar}{bar:50}{r_bar}{bar:-50b}",
+            position=0,
+            ascii=True)
+        self.progress_bars.append(progress_bar)
+        while True:
+            item = await write_queue.get()
+            if item is None:
+                break
+            module_name, analysis = item
+            result = await analysis
+            if self.workers > 1:
+                result, metrics = result
+                get_metrics().merge(metrics)
+            # the sheets and the files are written aside, the event loop keeps downloading and filling
+            await loop.run_in_executor(None, self.write_module, module_name, *result)
+            progress_bar.update()
+
+    async def fill_component(self, module_info: dict, component: dict) -> dict:
+        """With diff the current values are read first and the component is written only if one of them differs."""
+        component_id, component_version_id = get_component_versions(component)
+        try:
+            if self.diff:
+                custom_fields = await get_black_duck_custom_fields(
+                    self.client, self.headers, module_info['id'], module_info['versionId'],
+                    component_id, component_version_id)
+                resp = get_diff_answer(custom_fields, self.form_values)
+                if resp is not None:
+                    return resp
+            return await set_black_duck_custom_fields(
+                self.client, self.headers, module_info['id'], module_info['versionId'],
+                component_id, component_version_id, self.form_values)
+        except (httpx.HTTPError, ValueError) as e:
+            return {'errorMessage': str(e)}
+
+    async def fill_and_report(self, module_name: str, module_info: dict, component: dict, progress_bar: tqdm,
+                              in_flight: asyncio.Semaphore):
+        try:
+            resp = await self.fill_component(module_info, component)
+        except Exception as e:
+            resp = get_error_answer(e)
+        finally:
+            in_flight.release()
+        self.recorder.record(module_name, module_info, component, resp, progress_bar)
+
+    async def fill(self, fill_queue: asyncio.Queue):
+        in_flight = asyncio.Semaphore(self.max_workers)
+        position = 1
+        while True:
+            item = await fill_queue.get()
+            if item is None:
+                break
+            module_name, components = item
+            module_info = self.modules[module_name]
+            filled = self.recorder.get_filled(module_info)
+            progress_bar = tqdm(
+                total=len(components),
+                desc=module_name.ljust(15),
+                bar_format="{l_bar}{bar:50}{r_bar}{bar:-50b}",
+                position=position,
+                ascii=True)
+            self.progress_bars.append(progress_bar)
+            position += 1
+            skipped = dict.fromkeys(FillRecorder.SKIPPED_MESSAGES, 0)
+            for component in components:
+                reason = self.recorder.get_skip_reason(filled, module_info, component)
+                if reason is not None:
+                    skipped[reason] += 1
+                    progress_bar.update()
+                    continue
+                # at most max_workers components at the same time, the next ones wait here
+                await in_flight.acquire()
+                task = asyncio.ensure_future(
+                    self.fill_and_report(module_name, module_info, component, progress_bar, in_flight))
+                self.fill_tasks.add(task)
+                task.add_done_callback(self.fill_tasks.discard)
+            self.recorder.report_skipped(module_name, skipped)
+        if self.fill_tasks:
+            await asyncio.gather(*self.fill_tasks)
+
+
+def run_async_pipeline(modules: dict, headers: dict, branch_infos: dict, form_values: dict, workers: int = 1,
+                       state: StateStore = None, licenses_ndjson: bool = False, **fill_options):
+    """fill_options: max_workers, rate, diff and journal as in fill_black_duck_form."""
+    asyncio.run(AsyncPipeline(modules, headers, branch_infos, form_values, workers, state, licenses_ndjson,
+                              **fill_options).run())
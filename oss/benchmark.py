@@ -0,0 +1,360 @@
+"""Benchmark of the analyses and of the custom fields fill against a local fake Black Duck.
+
+The fake server serves synthetic BOMs (size and license mix configurable), can add latency to
+every answer and reply 429 to a share of the requests. Everything runs in a temporary workspace
+with a synthetic Rules file, so the real results in oss/ are not touched. Timings are printed
+as JSON (or saved with --output) to compare releases.
+
+    (venv)$ python oss/benchmark.py --modules 3 --components 2000 --latency 20 --throttle 0.05
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+import contextlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# license display -> weight in the synthetic BOMs
+DEFAULT_LICENSE_MIX = {
+    "MIT": 30,
+    "Apache 2.0": 25,
+    "BSD 3-clause \"New\" or \"Revised\" License": 10,
+    "(MIT AND BSD 3-clause \"New\" or \"Revised\" License)": 10,
+    "(GPL 2.0 OR MIT)": 10,
+    "GPL 2.0": 5,
+    "LGPL 2.1": 5,
+    "Unknown License": 5
+}
+USAGES = {"DYNAMICALLY_LINKED": 80, "STATICALLY_LINKED": 15, "STAND_ALONE": 5}
+RISK_LEVELS = ["UNKNOWN", "OK", "LOW", "MEDIUM", "HIGH", "CRITICAL"]
+# rule sets of the synthetic Rules file, given in turn to the single licenses
+RULE_SETS = ["AllApprove", "Permissive", "Copyleft"]
+DECISIONS = ["approve", "reject", "check"]
+PATH_PATTERN = '/api/projects/{project_id}/versions/{version_id}/'
+
+
+def get_license_names(license_display: str) -> list:
+    """Single licenses of a license expression of the mix."""
+    names = license_display.strip("()")
+    for operator in (" AND ", " OR "):
+        names = names.replace(operator, "\0")
+    return [name.strip("() ") for name in names.split("\0")]
+
+
+def generate_component(rng: random.Random, license_mix: dict, index: int) -> dict:
+    license_display = rng.choices(list(license_mix), weights=list(license_mix.values()))[0]
+    license_names = get_license_names(license_display)
+    licenses = []
+    if len(license_names) > 1:
+        licenses = [{"licenseDisplay": name, "spdxId": name.split()[0]} for name in license_names]
+    risk = rng.choice(RISK_LEVELS)
+    return {
+        "componentName": f"component-{index}",
+        "componentVersionName": f"{rng.randint(0, 9)}.{rng.randint(0, 20)}.{rng.randint(0, 99)}",
+        "componentVersion": f"/api/components/{uuid.UUID(int=rng.getrandbits(128))}"
+                            f"/versions/{uuid.UUID(int=rng.getrandbits(128))}",
+        "usages": rng.choices(list(USAGES), weights=list(USAGES.values())),
+        "licenses": [{"licenseDisplay": license_display, "spdxId": license_names[0].split()[0],
+                      "licenses": licenses}],
+        "licenseRiskProfile": {"counts": [{"countType": level, "count": int(level == risk)}
+                                          for level in RISK_LEVELS]}
+    }
+
+
+def generate_modules(module_count: int, component_count: int, license_mix: dict, seed: int) -> dict:
+    """module_name -> (module_info, components) of the synthetic BOMs."""
+    rng = random.Random(seed)
+    boms = {}
+    for module_index in range(module_count):
+        module_info = {"id": str(uuid.UUID(int=rng.getrandbits(128))),
+                       "versionId": str(uuid.UUID(int=rng.getrandbits(128)))}
+        components = [generate_component(rng, license_mix, index) for index in range(component_count)]
+        boms[f"Module{module_index}"] = (module_info, components)
+    return boms
+
+
+def write_rules_file(file_path: str, license_mix: dict, seed: int):
+    """Rules file with a rule set for every single license of the mix, except "Unknown License"."""
+    import openpyxl
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook(write_only=True)
+    licenses_sheet = workbook.create_sheet("Licenses")
+    licenses_sheet.append(["License", "Rule set"])
+    license_names = dict.fromkeys(name for display in license_mix for name in get_license_names(display))
+    for index, license_name in enumerate(license_names):
+        if license_name != "Unknown License":
+            licenses_sheet.append([license_name, RULE_SETS[index % len(RULE_SETS)]])
+    for rule_set in RULE_SETS[1:]:
+        sheet = workbook.create_sheet(rule_set)
+        sheet.append(["", "", "", "", "", "Decision"])
+        for _ in range(48):
+            sheet.append(["", "", "", "", "", rng.choice(DECISIONS)])
+    workbook.save(file_path)
+
+
+class FakeBlackDuck(ThreadingHTTPServer):
+    """Stand-in for the Black Duck API used by this tool: BOM pages, custom fields GET and PUT."""
+
+    daemon_threads = True
+
+    def __init__(self, boms: dict, latency: float = 0, throttle: float = 0, retry_after: float = 0,
+                 seed: int = 0):
+        super().__init__(('127.0.0.1', 0), FakeBlackDuckHandler)
+        self.components = {PATH_PATTERN.format(project_id=module_info["id"], version_id=module_info["versionId"]):
+                           components for module_info, components in boms.values()}
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        # custom fields written by the PUT requests: url -> answer of the GET
+        self.custom_fields = {}
+        self.stats = {"requests": 0, "throttled": 0, "bytes_sent": 0}
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeBlackDuckHandler(BaseHTTPRequestHandler):
+    # keep-alive, as Black Duck
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately: without TCP_NODELAY every answer waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status: int, answer: dict = None, headers: dict = None):
+        body = json.dumps(answer).encode() if answer is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.stats["bytes_sent"] += len(body)
+
+    def is_throttled(self) -> bool:
+        server = self.server
+        with server.lock:
+            server.stats["requests"] += 1
+            throttled = server.rng.random() < server.throttle
+            if throttled:
+                server.stats["throttled"] += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if throttled:
+            self.send(429, {"errorMessage": "Too many requests"}, {'Retry-After': str(server.retry_after)})
+        return throttled
+
+    def do_GET(self):
+        if self.is_throttled():
+            return
+        url = urlparse(self.path)
+        if url.path.endswith('/custom-fields'):
+            with self.server.lock:
+                answer = self.server.custom_fields.get(url.path, {"items": []})
+            self.send(200, answer)
+            return
+        components = self.server.components.get(url.path.rsplit('components', 1)[0])
+        if components is None:
+            self.send(404, {"errorMessage": f"{url.path} not found"})
+            return
+        query = parse_qs(url.query)
+        offset, limit = int(query["offset"][0]), int(query["limit"][0])
+        self.send(200, {"totalCount": len(components), "items": components[offset:offset + limit]})
+
+    def do_PUT(self):
+        # read even when throttled, or the body would be parsed as the next request of the connection
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.is_throttled():
+            return
+        items = [{"_meta": {"href": field["customField"]}, "values": field["values"]} for field in payload["fields"]]
+        with self.server.lock:
+            self.server.custom_fields[urlparse(self.path).path] = {"items": items}
+        self.send(200, {})
+
+
+def measure(function, repeat: int) -> dict:
+    """Seconds of every run of function, with min and median."""
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - start)
+    return {"runs": runs, "min": min(runs), "median": statistics.median(runs)}
+
+
+def run_benchmark(args) -> dict:
+    license_mix = DEFAULT_LICENSE_MIX
+    if args.license:
+        license_mix = {}
+        for value in args.license:
+            license_display, _, weight = value.rpartition(':')
+            license_mix[license_display] = float(weight)
+    boms = generate_modules(args.modules, args.components, license_mix, args.seed)
+    server = FakeBlackDuck(boms, args.latency / 1000, args.throttle, args.retry_after, args.seed)
+    server.start()
+
+    # the analyses write in <cwd>/oss, so they run inside a temporary workspace
+    workspace = tempfile.mkdtemp(prefix='oss-benchmark-')
+    os.makedirs(os.path.join(workspace, 'oss'))
+    write_rules_file(os.path.join(workspace, 'oss', 'Rules v073.xlsx'), license_mix, args.seed)
+    cwd = os.getcwd()
+    os.chdir(workspace)
+    try:
+        from enums import Obligation, DistributionType, ComponentModified, Hosting, HostControl, ComponentInteraction
+        from black_duck_api import configure_client, iter_project_components
+        from license_analysis import perform_license_analysis, collect_licenses
+        from components_analysis import perform_components_analysis, collect_components
+        from licenses_file import read_all_licenses
+        import components_analysis
+        from fill_forms import fill_black_duck_form
+        from metrics import get_metrics
+
+        configure_client(base_url=server.url, pool_size=max(10, args.fill_workers), max_retries=args.retries)
+        modules = {module_name: module_info for module_name, (module_info, _) in boms.items()}
+        headers = {"Authorization": "Bearer benchmark"}
+        branch_infos = {"Internal": True, "Modification": False, "Hosted": True, "Host_control_ABB": True}
+        form_values = {
+            "22": Obligation.AGREE,
+            "17": DistributionType.INTERNAL,
+            "16": ComponentModified.NO,
+            "13": Hosting.YES,
+            "12": HostControl.ABB,
+            "15": ComponentInteraction.DYNAMICALLY
+        }
+
+        end_to_end = {
+            "perform_license_analysis": measure(
+                lambda: perform_license_analysis(modules, headers, workers=args.workers), args.repeat),
+            "perform_components_analysis": measure(
+                lambda: perform_components_analysis(modules, headers, branch_infos, workers=args.workers),
+                args.repeat),
+            "fill_black_duck_form": measure(
+                lambda: fill_black_duck_form(modules, headers, form_values, max_workers=args.fill_workers,
+                                             rate=args.fill_rate, diff=args.fill_diff), args.repeat)
+        }
+
+        # the stages of the analyses, one at a time on the BOM already in memory
+        all_components = {}
+
+        def fetch():
+            for module_name, module_info in modules.items():
+                all_components[module_name] = list(iter_project_components(
+                    headers, module_info['id'], module_info['versionId']))
+
+        licenses_json, _ = read_all_licenses()
+        stages = {"fetch": measure(fetch, args.repeat)}
+        stages["collect_licenses"] = measure(
+            lambda: [collect_licenses(components) for components in all_components.values()], args.repeat)
+        stages["collect_components"] = measure(
+            lambda: [collect_components(components, licenses_json, branch_infos)
+                     for components in all_components.values()], args.repeat)
+
+        set_of_components = {module_name: collect_components(components, licenses_json, branch_infos)
+                             for module_name, components in all_components.items()}
+
+        def save_excel():
+            writer = components_analysis.get_writer()
+            for module_name, module_components in set_of_components.items():
+                components_analysis.save_into_excel(module_name, module_components, writer=writer)
+            writer.save()
+
+        stages["save_excel"] = measure(save_excel, args.repeat)
+        # instrumentation of all the runs above, stage by stage and call by call
+        metrics = get_metrics().get_report()
+    finally:
+        os.chdir(cwd)
+        server.stop()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    component_count = args.modules * args.components
+    for timing in list(end_to_end.values()) + list(stages.values()):
+        timing["components_per_second"] = component_count / timing["median"] if timing["median"] else None
+    return {
+        "benchmark": {
+            "modules": args.modules,
+            "components": args.components,
+            "license_mix": license_mix,
+            "latency_ms": args.latency,
+            "throttle": args.throttle,
+            "retry_after": args.retry_after,
+            "repeat": args.repeat,
+            "workers": args.workers,
+            "fill_workers": args.fill_workers,
+            "fill_rate": args.fill_rate,
+            "fill_diff": args.fill_diff,
+            "seed": args.seed
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "date": datetime.now(timezone.utc).isoformat()
+        },
+        "end_to_end": end_to_end,
+        "stages": stages,
+        "metrics": metrics,
+        "server": server.stats
+    }
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--modules', type=int, default=2, help="number of Black Duck projects (default 2)")
+    parser.add_argument('--components', type=int, default=1000, help="components of each BOM (default 1000)")
+    parser.add_argument('--license', action='append', metavar='LICENSE:WEIGHT',
+                        help="license of the synthetic BOMs with its weight, repeat for the mix (default: a mix "
+                             "of permissive, copyleft, AND/OR and unknown licenses)")
+    parser.add_argument('--latency', type=float, default=0, help="milliseconds added to every answer (default 0)")
+    parser.add_argument('--throttle', type=float, default=0,
+                        help="share of the requests answered with 429 (default 0)")
+    parser.add_argument('--retry-after', type=float, default=0,
+                        help="Retry-After seconds of the 429 answers (default 0)")
+    parser.add_argument('--retries', type=int, default=5, help="HTTP retries of the client (default 5)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of every measure (default 3)")
+    parser.add_argument('--workers', type=int, default=1, help="ANALYSIS_WORKERS of the analyses (default 1)")
+    parser.add_argument('--fill-workers', type=int, default=8, help="FILL_WORKERS of the fill (default 8)")
+    parser.add_argument('--fill-rate', type=float, default=0,
+                        help="FILL_RATE of the fill (default 0: no limit, to measure the code and not the limiter)")
+    parser.add_argument('--fill-diff', action='store_true', help="FILL_DIFF of the fill")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic BOMs (default 0)")
+    parser.add_argument('--output', help="json file where the results are saved (default: printed)")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    # messages and progress bars of the analyses must not mix with the json on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,201 @@
 import requests
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from metrics import get_metrics
 
 BASE_URL = 'https://abb.app.blackduck.com'
-QUERY_PARAMS = '?limit=9999&offset=0&sort=projectName%20ASC'
-CUSTUM_FIELD_VALUE_URL = BASE_URL + '/api/custom-fields/objects/bom-entry/fields'
+QUERY_PARAMS = '?limit={limit}&offset={offset}&sort=projectName%20ASC'
+# number of BOM components requested at each call
+PAGE_SIZE = 500
+CUSTUM_FIELD_VALUE_API = '/api/custom-fields/objects/bom-entry/fields'
+CUSTUM_FIELD_VALUE_URL = BASE_URL + CUSTUM_FIELD_VALUE_API
+# default settings of the HTTP client
+POOL_SIZE = 10
+TIMEOUT = (10, 120)  # (connect, read) in seconds
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5  # wait 0.5s, 1s, 2s, 4s, ... between two retries
+MAX_BACKOFF = 60
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
 
 
-def generate_payload(url: str, values: dict) -> dict:
+class BlackDuckError(Exception):
+    """Black Duck answered with an errorMessage."""
+
+
+class RateLimiter:
+    """Token bucket shared between threads: at most `rate` calls per second, bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            # no limit
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_retry_after(resp: requests.Response):
+    """Seconds to wait according to the Retry-After header (None if missing or invalid)."""
+    retry_after = resp.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        # Retry-After can also be an HTTP date
+        retry_date = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_date.tzinfo is None:
+        retry_date = retry_date.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_date - datetime.now(timezone.utc)).total_seconds())
+
+
+class RetryingClient:
+    """Settings and retry policy shared by the synchronous and the asyncio Black Duck clients.
+
+    request() of a client asks get_error_delay/get_response_delay after each attempt: they record
+    the metrics of the call and give how long to wait before the next attempt (None: no retry).
+    """
+
+    def __init__(self, base_url: str = BASE_URL, pool_size: int = POOL_SIZE, timeout=TIMEOUT,
+                 max_retries: int = MAX_RETRIES, backoff_factor: float = BACKOFF_FACTOR):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+
+    @property
+    def custom_field_value_url(self) -> str:
+        return self.base_url + CUSTUM_FIELD_VALUE_API
+
+    def get_url(self, api: str) -> str:
+        return api if api.startswith('http') else self.base_url + api
+
+    def get_backoff(self, attempt: int) -> float:
+        return min(MAX_BACKOFF, self.backoff_factor * (2 ** attempt))
+
+    def get_error_delay(self, method: str, error: Exception, elapsed: float, attempt: int):
+        """The call raised error (connection, timeout): None on the last attempt, the caller raises it."""
+        metrics = get_metrics()
+        metrics.observe('http_request_seconds', elapsed, method=method)
+        metrics.inc('http_requests_total', method=method, status=type(error).__name__)
+        if attempt == self.max_retries:
+            return None
+        metrics.inc('http_retries_total', method=method, reason=type(error).__name__)
+        return self.get_backoff(attempt)
+
+    def get_response_delay(self, method: str, resp, request_bytes: int, elapsed: float, attempt: int):
+        """The call got resp (requests or httpx): None when resp is the answer to return."""
+        metrics = get_metrics()
+        # the body is already downloaded (no stream), so it is part of the latency
+        metrics.observe('http_request_seconds', elapsed, method=method)
+        metrics.inc('http_requests_total', method=method, status=str(resp.status_code))
+        metrics.inc('http_request_bytes_total', request_bytes, method=method)
+        metrics.inc('http_response_bytes_total', len(resp.content), method=method)
+        if resp.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+            return None
+        metrics.inc('http_retries_total', method=method, reason=str(resp.status_code))
+        retry_after = get_retry_after(resp)
+        return retry_after if retry_after is not None else self.get_backoff(attempt)
+
+
+class BlackDuckClient(RetryingClient):
+    """HTTP client for Black Duck: pooled keep-alive session, timeouts and retry with exponential backoff."""
+
+    def __init__(self, base_url: str = BASE_URL, pool_size: int = POOL_SIZE, timeout=TIMEOUT,
+                 max_retries: int = MAX_RETRIES, backoff_factor: float = BACKOFF_FACTOR):
+        super().__init__(base_url, pool_size, timeout, max_retries, backoff_factor)
+        self.session = requests.Session()
+        # retries are handled by request(), the adapter only keeps the connections alive
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method: str, api: str, **kwargs) -> requests.Response:
+        url = self.get_url(api)
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                delay = self.get_error_delay(method, e, time.perf_counter() - start, attempt)
+                if delay is None:
+                    raise
+            else:
+                delay = self.get_response_delay(method, resp, len(resp.request.body or b''),
+                                                time.perf_counter() - start, attempt)
+                if delay is None:
+                    return resp
+                resp.close()
+            time.sleep(delay)
+
+    def get(self, api: str, **kwargs) -> requests.Response:
+        return self.request('GET', api, **kwargs)
+
+    def put(self, api: str, **kwargs) -> requests.Response:
+        return self.request('PUT', api, **kwargs)
+
+    def delete(self, api: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', api, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> BlackDuckClient:
+    """Client shared by all the functions of this module (created on first use)."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = BlackDuckClient()
+        return _client
+
+
+def configure_client(**kwargs) -> BlackDuckClient:
+    """Replace the shared client, kwargs are the ones of BlackDuckClient."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = BlackDuckClient(**kwargs)
+        return _client
+
+
+
+def generate_payload(url: str, values: dict, custom_field_value_url: str = CUSTUM_FIELD_VALUE_URL) -> dict:
     payload = {"fields": []}
     for field, enum in values.items():
         num_value = enum.value
         custom_field = f'{url}/{field}'
-        custom_field_values = f'{CUSTUM_FIELD_VALUE_URL}/{field}/options/{num_value}'
+        custom_field_values = f'{custom_field_value_url}/{field}/options/{num_value}'
         payload["fields"].append({
             "customField": custom_field,
             "values": [custom_field_values]
@@ -19,29 +203,157 @@ def generate_payload(url: str, values: dict) -> dict:
     return payload
 
 
-def get_project_components(api_headers: dict, project_id: str, version_id: str) -> dict:
-    api = f'/api/projects/{project_id}/versions/{version_id}/components'
-    url = BASE_URL + api + QUERY_PARAMS
-    resp = requests.get(url=url, headers=api_headers)
+class ComponentStream:
+    """Components of a project version, downloaded page by page (offset/limit).
+
+    The first page is requested immediately, so errors are raised here and `total` is known
+    before iterating. With prefetch the next page is downloaded in background while the
+    current one is consumed.
+
+    validators are the ones of every page of a previous download (see page_validators): the BOM
+    is not downloaded when all the pages answer 304, otherwise it is downloaded again in full.
+    """
+
+    def __init__(self, api_headers: dict, project_id: str, version_id: str, page_size: int = PAGE_SIZE,
+                 prefetch: bool = True, client: BlackDuckClient = None, validators: list = None):
+        self.api_headers = api_headers
+        self.api = f'/api/projects/{project_id}/versions/{version_id}/components'
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.client = client or get_client()
+        # offset -> {"etag", "last_modified"} of the pages downloaded
+        self.validators = {}
+        self.not_modified = bool(validators) and self.is_not_modified(validators)
+        if self.not_modified:
+            self._first_page = {"totalCount": 0, "items": []}
+        else:
+            self._first_page = self.fetch_page(0)
+        self.total = self._first_page.get('totalCount', len(self._first_page.get('items', [])))
+
+    @property
+    def page_validators(self) -> list:
+        """Validators of every page, in order, to revalidate this download later."""
+        return [self.validators[offset] for offset in sorted(self.validators)]
+
+    def is_not_modified(self, validators: list) -> bool:
+        """True when every page of the previous download answers 304 to a conditional request.
+
+        totalCount is part of every page, so a component added or removed changes all of them.
+        """
+        for index, page_validators in enumerate(validators):
+            headers = self.api_headers.copy()  # by value and not by reference
+            if page_validators.get('etag'):
+                headers['If-None-Match'] = page_validators['etag']
+            if page_validators.get('last_modified'):
+                headers['If-Modified-Since'] = page_validators['last_modified']
+            if len(headers) == len(self.api_headers):
+                # nothing to ask the server with
+                return False
+            query_params = QUERY_PARAMS.format(limit=self.page_size, offset=index * self.page_size)
+            with get_metrics().stage('fetch'):
+                resp = self.client.get(self.api + query_params, headers=headers)
+            if resp.status_code != 304:
+                return False
+        return True
+
+    def fetch_page(self, offset: int) -> dict:
+        query_params = QUERY_PARAMS.format(limit=self.page_size, offset=offset)
+        metrics = get_metrics()
+        with metrics.stage('fetch'):
+            resp = self.client.get(self.api + query_params, headers=self.api_headers)
+        with metrics.stage('parse'):
+            page = json.loads(resp.content)
+        metrics.add_rows('fetch', len(page.get('items', [])))
+        metrics.add_rows('parse', len(page.get('items', [])))
+        if 'errorMessage' in page:
+            raise BlackDuckError(page['errorMessage'])
+        self.validators[offset] = {"etag": resp.headers.get('ETag'), "last_modified": resp.headers.get('Last-Modified')}
+        return page
+
+    def iter_pages(self):
+        """Yields the list of components of each page."""
+        page, self._first_page = self._first_page, None
+        if page is None:
+            # already iterated once
+            page = self.fetch_page(0)
+        offset = 0
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                items = page.get('items', [])
+                offset += len(items)
+                has_next = len(items) > 0 and offset < self.total
+                if has_next and self.prefetch:
+                    next_page = executor.submit(self.fetch_page, offset)
+                yield items
+                if not has_next:
+                    break
+                page = next_page.result() if self.prefetch else self.fetch_page(offset)
+
+    def __iter__(self):
+        for items in self.iter_pages():
+            yield from items
+
+    def __len__(self):
+        return self.total
+
+
+def iter_project_components(api_headers: dict, project_id: str, version_id: str, page_size: int = PAGE_SIZE,
+                            prefetch: bool = True, client: BlackDuckClient = None, validators: list = None) -> ComponentStream:
+    """Raises BlackDuckError if the components can not be retrieved."""
+    return ComponentStream(api_headers, project_id, version_id, page_size, prefetch, client, validators)
+
+
+def get_project_components(api_headers: dict, project_id: str, version_id: str, client: BlackDuckClient = None) -> dict:
+    try:
+        components = iter_project_components(api_headers, project_id, version_id, client=client)
+    except BlackDuckError as e:
+        return {"errorMessage": str(e)}
+    items = list(components)
+    return {"totalCount": len(items), "items": items}
+
+
+def get_black_duck_custom_fields(api_headers: dict, project_id: str, project_version_id: str, component_id: str, component_version_id: str, client: BlackDuckClient = None):
+    client = client or get_client()
+    headers = api_headers.copy()  # by value and not by reference
+    headers["Accept"] = "application/json"
+    api = f'/api/projects/{project_id}/versions/{project_version_id}/components/{component_id}/versions/{component_version_id}/custom-fields'
+    resp = client.get(api, headers=headers)
     return json.loads(resp.content)
 
 
-def set_black_duck_custom_fields(api_headers: dict, project_id: str, project_version_id: str, component_id: str, component_version_id: str, values: dict):
+def get_custom_field_options(custom_fields: dict) -> dict:
+    """field id -> set of the selected option ids, from the answer of get_black_duck_custom_fields."""
+    options = {}
+    for item in custom_fields.get("items", []):
+        href = item.get("_meta", {}).get("href", "")
+        field = href.rstrip('/').rsplit('/', 1)[-1]
+        options[field] = {value.rstrip('/').rsplit('/', 1)[-1] for value in item.get("values", [])}
+    return options
+
+
+def is_up_to_date(custom_fields: dict, values: dict) -> bool:
+    """True when every value (field id -> enum) is already the one of the current custom fields."""
+    current_options = get_custom_field_options(custom_fields)
+    return all(current_options.get(field) == {str(enum.value)} for field, enum in values.items())
+
+
+def set_black_duck_custom_fields(api_headers: dict, project_id: str, project_version_id: str, component_id: str, component_version_id: str, values: dict, client: BlackDuckClient = None):
+    client = client or get_client()
     headers = api_headers.copy()  # by value and not by reference
     headers["Content-type"] = "application/json"
     headers["Accept"] = "application/json"
     api = f'/api/projects/{project_id}/versions/{project_version_id}/components/{component_id}/versions/{component_version_id}/custom-fields'
-    url = BASE_URL + api
-    payload = generate_payload(url, values)
-    resp = requests.put(url=url, headers=api_headers, json=payload)
+    url = client.base_url + api
+    payload = generate_payload(url, values, client.custom_field_value_url)
+    resp = client.put(api, headers=headers, json=payload)
     return json.loads(resp.content)
 
 # Function below is to test more depth, maybe blackDuck doesn't allow for the deletion of custom_fields
-def delete_black_duck_custom_fields(api_headers: dict, project_id: str, project_version_id: str, component_id: str, component_version_id: str):
+def delete_black_duck_custom_fields(api_headers: dict, project_id: str, project_version_id: str, component_id: str, component_version_id: str, client: BlackDuckClient = None):
+    client = client or get_client()
     headers = api_headers.copy()  # by value and not by reference
     headers["Content-type"] = "application/json"
     headers["Accept"] = "application/json"
     api = f'/api/projects/{project_id}/versions/{project_version_id}/components/{component_id}/versions/{component_version_id}/custom-fields'
-    url = BASE_URL + api
-    resp = requests.delete(url=url, headers=api_headers)
-    return json.loads(resp.content)
\ No newline at end of file
+    resp = client.delete(api, headers=headers)
+    return json.loads(resp.content)
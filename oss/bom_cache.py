@@ -0,0 +1,88 @@
+import os
+import json
+import time
+from black_duck_api import PAGE_SIZE, iter_project_components
+from metrics import get_metrics
+
+# folder where the BOM of every project version is saved
+CACHE_DIR = os.path.join(os.getcwd(), 'oss', '.bom_cache')
+# seconds after which a saved BOM is downloaded (or revalidated) again
+CACHE_TTL = 24 * 60 * 60
+
+
+class BomCache:
+    """On-disk cache of the BOM components, one json file per project version.
+
+    A BOM younger than `ttl` seconds is read from disk without any request. When it is older and
+    `revalidate` is set, Black Duck is asked with If-None-Match/If-Modified-Since whether every
+    page changed, and the saved BOM is kept only when all the pages answer 304.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, ttl: float = CACHE_TTL, revalidate: bool = False):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.revalidate = revalidate
+        # BOM downloaded by this process, valid for the whole run regardless of the ttl
+        self.fetched = set()
+
+    def get_path(self, project_id: str, version_id: str) -> str:
+        return os.path.join(self.cache_dir, f'{project_id}_{version_id}.json')
+
+    def load(self, project_id: str, version_id: str):
+        path = self.get_path(project_id, version_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            # corrupted file, download the BOM again
+            return None
+
+    def save(self, project_id: str, version_id: str, entry: dict):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.get_path(project_id, version_id)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as json_file:
+            json.dump(entry, json_file, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def get_components(self, api_headers: dict, project_id: str, version_id: str) -> list:
+        """Raises BlackDuckError if the components are not cached and can not be retrieved."""
+        metrics = get_metrics()
+        with metrics.stage('cache_read'):
+            entry = self.load(project_id, version_id)
+        if entry is not None and ((project_id, version_id) in self.fetched
+                                  or time.time() - entry["fetched_at"] < self.ttl):
+            metrics.inc('cache_requests_total', cache='bom', result='hit')
+            metrics.add_rows('cache_read', len(entry["items"]))
+            return entry["items"]
+
+        validators = None
+        if entry is not None and self.revalidate and entry.get("page_size") == PAGE_SIZE:
+            validators = entry.get("pages")
+        components = iter_project_components(
+            api_headers=api_headers, project_id=project_id, version_id=version_id, validators=validators)
+        if components.not_modified:
+            metrics.inc('cache_requests_total', cache='bom', result='revalidated')
+            entry["fetched_at"] = time.time()
+        else:
+            metrics.inc('cache_requests_total', cache='bom', result='miss')
+            items = list(components)
+            entry = {
+                "fetched_at": time.time(),
+                "page_size": PAGE_SIZE,
+                "pages": components.page_validators,
+                "items": items
+            }
+        self.save(project_id, version_id, entry)
+        self.fetched.add((project_id, version_id))
+        return entry["items"]
+
+
+def get_components(api_headers: dict, module_info: dict, bom_cache: BomCache = None):
+    """Components of a module: read through the cache if given, streamed from Black Duck otherwise."""
+    if bom_cache is None:
+        return iter_project_components(
+            api_headers=api_headers, project_id=module_info['id'], version_id=module_info['versionId'])
+    return bom_cache.get_components(api_headers, module_info['id'], module_info['versionId'])
@@ -0,0 +1,98 @@
+from itertools import islice
+import numpy as np
+import pandas as pd
+from black_duck_api import PAGE_SIZE
+from enums import ComponentInteractionRules, RiskFlag
+from license_expression import strip_outer_parentheses
+from records import ComponentRecord
+from rules import FIXED_DECISIONS, DecisionTable, get_decision_index
+from metrics import get_metrics
+
+# components converted to a frame at once: a page of the BOM
+CHUNK_SIZE = PAGE_SIZE
+# columns of the frame, in the order of the ComponentRecord arguments
+RECORD_COLUMNS = ["component", "component_version", "usage", "license", "risk"]
+
+
+def iter_chunks(components, chunk_size: int = CHUNK_SIZE):
+    """Lists of chunk_size components; a stream keeps downloading the next page meanwhile."""
+    iterator = iter(components)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def map_distinct(values, function) -> np.ndarray:
+    """function applied once per distinct value (a BOM repeats the same few licenses and usages)."""
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    return np.array([function(value) for value in uniques] + [None], dtype=object)[codes]
+
+
+def get_usages(usages: pd.Series) -> np.ndarray:
+    # a single usage as it is, more usages each followed by a space
+    joined = usages.str.join(" ")
+    return np.where(usages.str.len() > 1, joined + " ", joined)
+
+
+def get_risks(counts: pd.DataFrame) -> np.ndarray:
+    """RiskFlag bits of the risk levels with a count != 0; a missing count type counts as 0."""
+    risks = np.zeros(len(counts), dtype=np.int64)
+    for flag in RiskFlag:
+        if flag.name in counts:
+            risks |= np.where(counts[flag.name].fillna(0).to_numpy() != 0, flag.value, 0)
+    return risks
+
+
+def components_to_frame(components: list) -> pd.DataFrame:
+    """Columns of RECORD_COLUMNS for the components of a BOM page."""
+    counts = pd.DataFrame(
+        [{count["countType"]: count["count"] for count in component.get("licenseRiskProfile", {}).get("counts", [])}
+         for component in components],
+        index=range(len(components)))
+    return pd.DataFrame({
+        "component": [component["componentName"] for component in components],
+        "component_version": [component["componentVersionName"] for component in components],
+        "usage": get_usages(pd.Series([component["usages"] for component in components], dtype=object)),
+        "license": map_distinct([component["licenses"][0]["licenseDisplay"] for component in components],
+                                strip_outer_parentheses),
+        "risk": get_risks(counts)
+    })
+
+
+def frame_to_records(frame: pd.DataFrame) -> list:
+    # tolist gives python values (json can not handle numpy integers)
+    return [ComponentRecord(*row) for row in zip(*(frame[column].tolist() for column in RECORD_COLUMNS))]
+
+
+def get_component_records(components: list) -> list:
+    if not components:
+        return []
+    with get_metrics().stage('normalize', rows=len(components)):
+        return frame_to_records(components_to_frame(components))
+
+
+def get_rule_sets(licenses: list, licenses_json: dict) -> list:
+    """Rule set of every license, joined on the "All" licenses (None when the license is missing)."""
+    rule_sets = pd.Series(licenses, dtype=object).map(
+        {license: value["rule_set"] for license, value in licenses_json.items()})
+    return rule_sets.astype(object).where(rule_sets.notna(), None).tolist()
+
+
+def get_decisions(decision_table: DecisionTable, rule_sets: list, usages: list, branch_infos: dict) -> list:
+    """Decision of every component: one array lookup per rule set instead of one per component."""
+    interaction_values = map_distinct(usages, lambda usage: ComponentInteractionRules[usage].value)
+    decision_indexes = get_decision_index(branch_infos, 0) + interaction_values.astype(np.int64)
+    codes, uniques = pd.factorize(pd.Series(rule_sets, dtype=object))
+    # rule set missing: the table returns NOT_FOUND as for an unknown sheet
+    decisions = np.full(len(rule_sets), decision_table.get(None, 0), dtype=object)
+    for code, rule_set in enumerate(uniques):
+        rows = codes == code
+        column = None if rule_set in FIXED_DECISIONS else decision_table.decisions.get(rule_set)
+        if column is None:
+            # fixed decision or unknown rule set, the same for every row
+            decisions[rows] = decision_table.get(rule_set, 0)
+        else:
+            decisions[rows] = np.array(column, dtype=object)[decision_indexes[rows]]
+    return decisions.tolist()
@@ -1,226 +1,139 @@
 import os
-import pandas as pd
-import openpyxl
-import json
+from functools import partial
 from tqdm import tqdm
 from datetime import datetime
-from black_duck_api import get_project_components
-from enums import ComponentInteractionRules
+from black_duck_api import BlackDuckError
+from bom_cache import BomCache, get_components
+from rules import RULES_FILE_PATH, get_decision_table
+from excel_export import WorkbookWriter
+from parallel import analyze_modules
+from metrics import get_metrics
+from licenses_file import read_all_licenses
+import bom_frame
 
 # name of the Excel file where save the result
 WORKSPACE_OCC_DIR = os.path.join(os.getcwd(), 'oss')
 FILE_NAME = 'LitePanelPro-BlackDuckComponents.xlsx'
-LICENSES_FILE_PATH = os.path.join(WORKSPACE_OCC_DIR, 'licenses_to_check.json')
-RULES_FILE_PATH = os.path.join(WORKSPACE_OCC_DIR, 'Rules v073.xlsx')
-RULES_DATA_FRAME = pd.read_excel(RULES_FILE_PATH, sheet_name='Licenses')
 
 
-def save_licenses_ruleset(sheet_components, licenses_json):
-    for row_number_comp, _ in enumerate(sheet_components.iter_rows(min_row=2), start=2):
-        for license_name in licenses_json:
-            if sheet_components.cell(row=row_number_comp, column=4).value == license_name:
-                sheet_components.cell(
-                    row=row_number_comp, column=6, value=licenses_json[license_name]["rule_set"])
-                sheet_components.cell(
-                    row=row_number_comp, column=6, value=licenses_json[license_name]["rule_set"])
-                break  # To check if this works because I wrongly used pass before but this should be just fine
+DECISION_SYMBOLS = {"reject": "❌", "approve": "✔️", "check": "🤷‍♀️"}
 
 
-def get_decision(workbook, spreadsheet_name, branch_infos,
-                 interaction_rule: ComponentInteractionRules):
-    """Retrieves a decision based on the Rule set and parameters."""
+def save_licenses_ruleset(set_of_components: list, licenses_json: dict):
+    """Fills rule_set of every component, joining its license on licenses_json."""
+    with get_metrics().stage('rule_resolution', rows=len(set_of_components)):
+        rule_sets = bom_frame.get_rule_sets([component.license for component in set_of_components], licenses_json)
+    for component, rule_set in zip(set_of_components, rule_sets):
+        if rule_set is not None:
+            component.rule_set = rule_set
 
-    if spreadsheet_name == "AllApprove":
-        return "approve"
 
-    if spreadsheet_name == "AllReject":
-        return "reject"
+def save_decisions(set_of_components: list, branch_infos: dict):
+    """Fills decision of every component from its rule_set and usage."""
+    with get_metrics().stage('decision', rows=len(set_of_components)):
+        decisions = bom_frame.get_decisions(
+            get_decision_table(),
+            [component.rule_set for component in set_of_components],
+            [component.usage for component in set_of_components],
+            branch_infos)
+    for component, decision in zip(set_of_components, decisions):
+        component.decision = decision
+        if decision == "reject":
+            print("component: ", component.component, " doesn't comply.")
+        elif decision == "check":
+            print("component: ", component.component, " to check.")
+        elif decision != "approve":
+            print("component: ", component.component, " not found.")
 
-    if spreadsheet_name in workbook.sheetnames:
-        rule_sheet = workbook[spreadsheet_name]
-    else:
-        return "NOT_FOUND"
-
-    selected_row = 2
-    if not branch_infos["Internal"]:
-        selected_row = selected_row + 24
 
-    if not branch_infos["Modification"]:
-        selected_row = selected_row + 12
-
-    if not branch_infos["Hosted"]:
-        selected_row = selected_row + 8
-    else:
-        if not branch_infos["Host_control_ABB"]:
-            selected_row = selected_row + 4
+def get_writer() -> WorkbookWriter:
+    return WorkbookWriter(os.path.join(WORKSPACE_OCC_DIR, FILE_NAME))
 
-    selected_row = selected_row + interaction_rule.value
 
-    return rule_sheet.cell(row=selected_row, column=6).value
-
-
-def save_into_excel(sheet_name: str, set_of_components: dict, branch_infos: dict):
-    file_path = os.path.join(WORKSPACE_OCC_DIR, FILE_NAME)
-    if not os.path.exists(file_path):
-        workbook = openpyxl.Workbook()
-    else:
-        workbook = openpyxl.load_workbook(file_path)
-    if sheet_name in workbook.sheetnames:
-        sheet = workbook[sheet_name]
+def save_into_excel(sheet_name: str, set_of_components: list, licenses_datetime: datetime = None,
+                    writer: WorkbookWriter = None):
+    """Adds the sheet to writer; without writer the Excel file is saved immediately."""
+    header = ["COMPONENT", "COMPONENT VERSION", "USAGE", "LICENSE", "LICENSE RISK"]
+    if licenses_datetime is None:
+        header.append("To load column \"RULE SET\", first analyze the licenses of this project.")
     else:
-        sheet = workbook.create_sheet(sheet_name)
-
-    sheet.cell(row=1, column=1, value="COMPONENT")
-    sheet.cell(row=1, column=2, value="COMPONENT VERSION")
-    sheet.cell(row=1, column=3, value="USAGE")
-    sheet.cell(row=1, column=4, value="LICENSE")
-    sheet.cell(row=1, column=5, value="LICENSE RISK")
-
-    for row, (_, value) in enumerate(set_of_components.items(), start=2):
-        sheet.cell(row=row, column=1, value=value["COMPONENT"])
-        sheet.cell(row=row, column=2, value=value["COMPONENT_VERSION"])
-        sheet.cell(row=row, column=3, value=value["USAGE"])
-        sheet.cell(row=row, column=4, value=value["LICENSE"])
-        sheet.cell(row=row, column=5, value=value["LICENSE_RISK"])
-
-    if not os.path.exists(LICENSES_FILE_PATH):
-        sheet.cell(
-            row=1, column=6, value="To load column \"RULE SET\", first analyze the licenses of this project.")
-    else:
-        with open(LICENSES_FILE_PATH) as json_file:
-            licenses_json = json.load(json_file)
-            # easier to use "All" instead of sheet_name but could be different with more sheets
-            licenses_json = licenses_json["All"]
-
-            creation_timestamp = os.path.getctime(LICENSES_FILE_PATH)
-            creation_datetime = datetime.fromtimestamp(creation_timestamp)
-            header = f"RULESET (last update: {
-                creation_datetime.strftime('%Y-%m-%d %H:%M:%S')})"
-
-            sheet.cell(row=1, column=6, value=header)
-            save_licenses_ruleset(sheet_components=sheet,
-                                  licenses_json=licenses_json)
-
+        header.append(f"RULESET (last update: {licenses_datetime.strftime('%Y-%m-%d %H:%M:%S')})")
         if not os.path.exists(RULES_FILE_PATH):
-            sheet.cell(
-                row=1, column=7, value="To load column \"BRANCH FOR APPROVAL\", add the Rules file inside the folder oss")
+            header.append("To load column \"BRANCH FOR APPROVAL\", add the Rules file inside the folder oss")
         else:
-            sheet.cell(row=1, column=7, value="APPROVED ❌✔️🤷‍♀️")
-            workbook_rules = openpyxl.load_workbook(RULES_FILE_PATH)
-            for row_number_comp, _ in enumerate(sheet.iter_rows(min_row=2),
-                                                start=2):
-                usage_str = sheet.cell(row=row_number_comp, column=3).value
-                # Using column RULESET to calculate decision
-                decision = get_decision(workbook_rules,
-                                        sheet.cell(row=row_number_comp,
-                                                   column=6).value,
-                                        branch_infos,
-                                        ComponentInteractionRules[usage_str])
-
-                if decision == "reject":
-                    sheet.cell(row=row_number_comp, column=7, value="❌")
-                    print("component: ",
-                          sheet.cell(row=row_number_comp, column=1).value,
-                          " doesn't comply.")
-                elif decision == "approve":
-                    sheet.cell(row=row_number_comp, column=7, value="✔️")
-                elif decision == "check":
-                    sheet.cell(row=row_number_comp, column=7, value="🤷‍♀️")
-                    print("component: ",
-                          sheet.cell(row=row_number_comp, column=1).value,
-                          " to check.")
-                else:
-                    sheet.cell(row=row_number_comp,
-                               column=7, value="Not found")
-                    print("component: ",
-                          sheet.cell(row=row_number_comp, column=1).value,
-                          " not found.")
-
-    workbook.save(file_path)
-    workbook.close()
-
-
-def get_rule_set(splitter="Z"*10, license_name="") -> str:
-    licenses_splitted = license_name.split(splitter)
-    rule_set = []
-    for license in licenses_splitted:
-        try:
-            rule_set.append(
-                RULES_DATA_FRAME[RULES_DATA_FRAME["License"] == license]
-                ['Rule set'].values[0])
-        except IndexError:
-            # in case license is not found
-            rule_set.append("NOT_FOUND")
-    return splitter.join(rule_set)
-
-
-def analyze_components(module_name: str, module_info: dict, headers: dict, branch_infos: dict) -> dict:
-    resp = get_project_components(
-        api_headers=headers, project_id=module_info['id'], version_id=module_info['versionId'])
-
-    if 'errorMessage' in resp:
-        print(f"Error on get components for {
-              module_name}: {resp['errorMessage']}")
+            header.append("APPROVED ❌✔️🤷‍♀️")
+
+    rows = [header]
+    for component in set_of_components:
+        decision = component.decision
+        if decision is not None:
+            decision = DECISION_SYMBOLS.get(decision, "Not found")
+        rows.append([component.component, component.component_version, component.usage,
+                     component.license, component.license_risk, component.rule_set, decision])
+
+    if writer is None:
+        writer = get_writer()
+        writer.add_sheet(sheet_name, rows)
+        writer.save()
+    else:
+        writer.add_sheet(sheet_name, rows)
+
+
+def collect_components(components, licenses_json: dict = None, branch_infos: dict = None) -> list:
+    """Components of the BOM; with licenses_json (and the Rules file) also their rule set and decision.
+
+    The BOM is processed a page at a time, so only one frame is in memory while the next page
+    is downloaded.
+    """
+    set_of_components = []
+    for chunk in bom_frame.iter_chunks(components):
+        chunk_components = bom_frame.get_component_records(chunk)
+        # rule set and decision are added before writing the sheet
+        if licenses_json is not None:
+            save_licenses_ruleset(chunk_components, licenses_json)
+            if os.path.exists(RULES_FILE_PATH):
+                save_decisions(chunk_components, branch_infos)
+        set_of_components.extend(chunk_components)
+    return set_of_components
+
+
+def analyze_components(module_name: str, module_info: dict, headers: dict, branch_infos: dict, bom_cache: BomCache = None,
+                       writer: WorkbookWriter = None, licenses: tuple = None) -> list:
+    """licenses: (licenses_json, licenses_datetime) of read_all_licenses, read here when not given."""
+    licenses_json, licenses_datetime = licenses or read_all_licenses()
+    try:
+        components = get_components(headers, module_info, bom_cache)
+        # components are processed while the next page is downloaded
+        set_of_components = collect_components(tqdm(
+            components,
+            total=len(components),
+            desc=module_name.ljust(15),
+            bar_format="{l_bar}{bar:50}{r_bar}{bar:-50b}", ascii=True), licenses_json, branch_infos)
+    except BlackDuckError as e:
+        print(f"Error on get components for {module_name}: {e}")
         return None
+
+    # save result in excel file
+    save_into_excel(sheet_name=module_name, set_of_components=set_of_components,
+                    licenses_datetime=licenses_datetime, writer=writer)
+    return set_of_components
+
+
+def perform_components_analysis(modules: dict, headers: dict, branch_infos: dict, bom_cache: BomCache = None,
+                                workers: int = 1):
+    """workers > 1 analyzes the modules in parallel processes."""
+    # all the sheets are written in a single pass at the end
+    writer = get_writer()
+    # the licenses file holds every module, it is read once for all of them
+    licenses_json, licenses_datetime = read_all_licenses()
+    if workers > 1:
+        analyze = partial(collect_components, licenses_json=licenses_json, branch_infos=branch_infos)
+        for module_name, set_of_components in analyze_modules(modules, headers, analyze, workers, bom_cache):
+            save_into_excel(sheet_name=module_name, set_of_components=set_of_components,
+                            licenses_datetime=licenses_datetime, writer=writer)
     else:
-        set_of_components = {}
-        for index, component in enumerate(tqdm(
-                resp["items"],
-                desc=module_name.ljust(15),
-                bar_format="{l_bar}{bar:50}{r_bar}{bar:-50b}", ascii=True)):
-
-            set_of_components[index] = {
-                "COMPONENT": component["componentName"],
-                "COMPONENT_VERSION": component["componentVersionName"],
-                "USAGE": "",
-                "LICENSE": "",
-                "LICENSE_RISK": "",
-            }
-
-            if len(component["usages"]) == 1:
-                set_of_components[index]["USAGE"] = component["usages"][0]
-            else:
-                for usg in component["usages"]:
-                    set_of_components[index]["USAGE"] += f"{usg} "
-
-            if component["licenses"][0]["licenseDisplay"][0] == "(":
-                set_of_components[index]["LICENSE"] = component["licenses"][0]["licenseDisplay"][1:-1]
-            else:
-                set_of_components[index]["LICENSE"] = component["licenses"][0]["licenseDisplay"]
-
-            for count in component["licenseRiskProfile"]["counts"]:
-                if count["countType"] == "UNKNOWN":
-                    unknown = count["count"]
-                if count["countType"] == "OK":
-                    ok = count["count"]
-                if count["countType"] == "LOW":
-                    low = count["count"]
-                if count["countType"] == "MEDIUM":
-                    medium = count["count"]
-                if count["countType"] == "HIGH":
-                    high = count["count"]
-                if count["countType"] == "CRITICAL":
-                    critical = count["count"]
-
-            risk_counts = {
-                "UNKNOWN": unknown,
-                "OK": ok,
-                "LOW": low,
-                "MEDIUM": medium,
-                "HIGH": high,
-                "CRITICAL": critical
-            }
-
-            for risk, count in risk_counts.items():
-                if count != 0:
-                    set_of_components[index]["LICENSE_RISK"] += f"{risk} "
-
-        # save result in excel file
-        save_into_excel(sheet_name=module_name,
-                        set_of_components=set_of_components, branch_infos=branch_infos)
-        return set_of_components
-
-
-def perform_components_analysis(modules: dict, headers: dict, branch_infos: dict):
-    for module_name, module_info in modules.items():
-        analyze_components(module_name, module_info, headers, branch_infos)
+        for module_name, module_info in modules.items():
+            analyze_components(module_name, module_info, headers, branch_infos, bom_cache, writer,
+                               (licenses_json, licenses_datetime))
+    if writer.sheets:
+        writer.save()
@@ -0,0 +1,60 @@
+import json
+import enums
+
+# keys of the config file, all optional: the ones missing keep the values of __main__.py
+CONFIG_KEYS = ("modules", "form_values", "scan_infos")
+# branch of the project, read by rules.get_decision_index
+SCAN_INFOS_KEYS = ("Internal", "Modification", "Hosted", "Host_control_ABB")
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def parse_form_value(field_id: str, value):
+    """"Obligation.AGREE" -> Obligation.AGREE (the value ids of Black Duck are the ones of enums.py)."""
+    enum_name, _, member_name = str(value).partition('.')
+    enum_class = getattr(enums, enum_name, None)
+    if (not isinstance(enum_class, type) or not issubclass(enum_class, enums.Enum)
+            or member_name not in enum_class.__members__):
+        raise ConfigError(f"form_values[{field_id!r}]: {value!r} is not an enum value like \"Obligation.AGREE\"")
+    return enum_class[member_name]
+
+
+def load_config(file_path: str) -> dict:
+    """Modules, form values and scan infos of a json config file.
+
+    {
+        "modules": {"<module>": {"id": "<project id>", "versionId": "<version id>"}},
+        "form_values": {"<custom field id>": "<Enum>.<VALUE>"},
+        "scan_infos": {"Internal": true, ...}
+    }
+    """
+    try:
+        with open(file_path) as config_file:
+            config = json.load(config_file)
+    except (OSError, ValueError) as e:
+        raise ConfigError(f"cannot read {file_path}: {e}")
+    if not isinstance(config, dict):
+        raise ConfigError(f"{file_path}: a json object is expected")
+    unknown_keys = set(config) - set(CONFIG_KEYS)
+    if unknown_keys:
+        raise ConfigError(f"{file_path}: unknown keys {', '.join(sorted(unknown_keys))}")
+    for key in CONFIG_KEYS:
+        if key in config and not isinstance(config[key], dict):
+            raise ConfigError(f"{file_path}: {key} must be a json object")
+    for module_name, module_info in config.get("modules", {}).items():
+        if (not isinstance(module_info, dict)
+                or not all(isinstance(module_info.get(key), str) for key in ("id", "versionId"))):
+            raise ConfigError(f"modules[{module_name!r}]: \"id\" and \"versionId\" strings are required")
+    if "form_values" in config:
+        config["form_values"] = {field_id: parse_form_value(field_id, value)
+                                 for field_id, value in config["form_values"].items()}
+    if "scan_infos" in config:
+        scan_infos = config["scan_infos"]
+        if set(scan_infos) != set(SCAN_INFOS_KEYS):
+            raise ConfigError(f"scan_infos: exactly the keys {', '.join(SCAN_INFOS_KEYS)} are required")
+        for key, value in scan_infos.items():
+            if not isinstance(value, bool):
+                raise ConfigError(f"scan_infos[{key!r}]: true or false is expected, not {value!r}")
+    return config
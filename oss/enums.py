@@ -1,4 +1,4 @@
-from enum import Enum
+from enum import Enum, IntFlag
 
 
 class Obligation(Enum):
@@ -40,3 +40,13 @@ class ComponentInteractionRules(Enum):
     # To check if it is saved as STAND_ALONE or STAND-ALONE on blackduck (the project I analyzed never had this field before)
     STAND_ALONE = 2
     OTHERS = 3
+
+
+class RiskFlag(IntFlag):
+    # license risk levels with a count != 0, in the order they are shown
+    UNKNOWN = 1
+    OK = 2
+    LOW = 4
+    MEDIUM = 8
+    HIGH = 16
+    CRITICAL = 32
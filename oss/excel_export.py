@@ -0,0 +1,71 @@
+import os
+import openpyxl
+from metrics import get_metrics
+
+
+class WorkbookWriter:
+    """Sheets of an output Excel file, kept in memory and written in a single pass.
+
+    A new file is saved with openpyxl write_only mode. An existing file is opened once: the
+    replaced sheets get the new values cell by cell (fonts, widths and merges stay) and the other
+    sheets are left untouched. kept_columns (1-based) are the columns typed by the users: in the
+    replaced sheets they are carried over to the new row with the same value in the first column.
+    """
+
+    def __init__(self, file_path: str, kept_columns: range = range(0)):
+        self.file_path = file_path
+        self.kept_columns = kept_columns
+        self.sheets = {}
+
+    def add_sheet(self, sheet_name: str, rows: list):
+        """rows: list of rows (lists of values), header included."""
+        self.sheets[sheet_name] = rows
+
+    def save(self):
+        rows = sum(len(sheet_rows) for sheet_rows in self.sheets.values())
+        with get_metrics().stage('excel_write', rows=rows):
+            self.write()
+        self.sheets = {}
+
+    def write(self):
+        if os.path.exists(self.file_path):
+            workbook = openpyxl.load_workbook(self.file_path)
+            for sheet_name, rows in self.sheets.items():
+                if sheet_name in workbook.sheetnames:
+                    # replaced sheets keep their position and their formatting
+                    self.replace_rows(workbook[sheet_name], rows)
+                else:
+                    sheet = workbook.create_sheet(sheet_name)
+                    for row in rows:
+                        sheet.append(row)
+        else:
+            workbook = openpyxl.Workbook(write_only=True)
+            for sheet_name, rows in self.sheets.items():
+                sheet = workbook.create_sheet(sheet_name)
+                for row in rows:
+                    sheet.append(row)
+            if not workbook.sheetnames:
+                workbook.create_sheet("Sheet")
+
+        # the existing file is read above, so it is replaced only at the end
+        tmp_path = self.file_path + '.tmp.xlsx'
+        workbook.save(tmp_path)
+        os.replace(tmp_path, self.file_path)
+
+    def replace_rows(self, sheet, rows: list):
+        kept_values = {}
+        if self.kept_columns:
+            for old_row in sheet.iter_rows(min_row=2, max_col=max(self.kept_columns), values_only=True):
+                if old_row and old_row[0] is not None:
+                    kept_values[old_row[0]] = [old_row[column - 1] for column in self.kept_columns]
+        for row_number, row in enumerate(rows, start=1):
+            for column, value in enumerate(row, start=1):
+                # cell(value=None) would leave the old value
+                sheet.cell(row=row_number, column=column).value = value
+            if row_number > 1 and self.kept_columns:
+                values = kept_values.get(row[0], [None] * len(self.kept_columns))
+                for column, value in zip(self.kept_columns, values):
+                    sheet.cell(row=row_number, column=column).value = value
+        if sheet.max_row > len(rows):
+            # rows of the licenses/components that are gone
+            sheet.delete_rows(len(rows) + 1, sheet.max_row - len(rows))
@@ -1,7 +1,23 @@
 import re
-import time
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from black_duck_api import *
+from bom_cache import BomCache, get_components
+from state_store import StateStore, get_form_key
+from metrics import get_metrics
+from fill_journal import FillJournal, load_retry_batch
+
+# number of PUT requests in flight at the same time
+MAX_WORKERS = 8
+# token bucket replacing the old fixed sleep(0.5) between two PUT
+REQUESTS_PER_SECOND = 2.0
+BURST = 4
+# components queued for each worker, so that memory does not grow with the BOM size
+QUEUED_PER_WORKER = 4
+# modules whose BOM is read ahead while the current one is filled
+PREFETCHED_MODULES = 2
 
 
 def get_component_versions(component):
@@ -10,23 +26,212 @@ def get_component_versions(component):
     return re.findall(pattern, component['componentVersion'])[0]
 
 
-def fill_black_duck_form(modules: dict, headers: dict, form_values: dict):
-    for module_name, module_info in modules.items():
-        resp = get_project_components(
-            api_headers=headers, project_id=module_info['id'], version_id=module_info['versionId'])
+def get_diff_answer(custom_fields: dict, form_values: dict):
+    """diff mode: answer of the component when nothing is written, None when form_values has to be written.
+
+    A component with at least one differing field gets all of form_values: the PUT on the custom
+    fields replaces them, so a partial body would clear the fields left out.
+    """
+    if 'errorMessage' in custom_fields:
+        return custom_fields
+    if is_up_to_date(custom_fields, form_values):
+        return {'up_to_date': True}
+    return None
+
+
+def fill_component(headers: dict, module_info: dict, component: dict, form_values: dict, rate_limiter: RateLimiter,
+                   diff: bool = False) -> dict:
+    """With diff the current values are read first and the component is written only if one of them differs.
+
+    The answer of a component not written gets "up_to_date".
+    """
+    component_id, component_version_id = get_component_versions(component)
+    try:
+        if diff:
+            rate_limiter.acquire()
+            custom_fields = get_black_duck_custom_fields(headers, module_info['id'], module_info['versionId'], component_id, component_version_id)
+            resp = get_diff_answer(custom_fields, form_values)
+            if resp is not None:
+                return resp
+        rate_limiter.acquire()
+        return set_black_duck_custom_fields(headers, module_info['id'], module_info['versionId'], component_id, component_version_id, form_values)
+    except (requests.RequestException, ValueError) as e:
+        return {'errorMessage': str(e)}
+
+
+class FillRecorder:
+    """Outcome of the components of a fill, shared by fill_black_duck_form and the asyncio pipeline.
+
+    Components skipped (already filled according to the state, or written before an interruption
+    according to the journal) and answers of the writes go to the journal, the state, the metrics,
+    the progress bar and the counts of diff mode.
+    """
+
+    SKIPPED_MESSAGES = {
+        'already_filled': "components already filled by a previous run",
+        'resumed': "components written before the interruption"
+    }
+
+    def __init__(self, form_values: dict, state: StateStore = None, journal: FillJournal = None):
+        self.form_key = get_form_key(form_values)
+        self.state = state
+        self.journal = journal
+        # writes not sent because Black Duck already had the values (diff mode)
+        self.stats = {'skipped_components': 0}
+        # tqdm output and counts, from the threads of the executor
+        self.lock = threading.Lock()
+
+    def get_filled(self, module_info: dict) -> dict:
+        if self.state is None:
+            return {}
+        return self.state.get_filled(module_info['id'], module_info['versionId'])
+
+    def get_skip_reason(self, filled: dict, module_info: dict, component: dict):
+        """None when the component has to be written; filled comes from get_filled."""
+        if filled.get(component['componentVersion']) == self.form_key:
+            return 'already_filled'
+        if self.journal is not None and self.journal.is_done(module_info, component):
+            return 'resumed'
+        return None
+
+    def report_skipped(self, module_name: str, skipped: dict):
+        """skipped: reason -> number of components of the module."""
+        for reason, count in skipped.items():
+            if count:
+                get_metrics().inc('fill_components_total', count, result=reason)
+                with self.lock:
+                    tqdm.write(f"{module_name}: {count} {self.SKIPPED_MESSAGES[reason]}, skipped")
+
+    def record(self, module_name: str, module_info: dict, component: dict, resp: dict, progress_bar: tqdm):
         if 'errorMessage' in resp:
-            print(
-                f"Error on get components for {module_name}: {resp['errorMessage']}")
+            if self.journal is not None:
+                self.journal.add_failure(module_name, module_info, component, resp['errorMessage'])
         else:
-            for index, component in enumerate(tqdm(
-                    resp["items"],
-                    desc=module_name.ljust(15),
-                    bar_format="{l_bar}{bar:50}{r_bar}{bar:-50b}", 
-                    ascii=True)):
-                component_id, component_version_id = get_component_versions(component)
-
-                resp = set_black_duck_custom_fields(headers, module_info['id'], module_info['versionId'], component_id, component_version_id, form_values)
-                if 'errorMessage' in resp:
+            if self.journal is not None:
+                self.journal.record(module_info, component)
+            if self.state is not None:
+                self.state.save_filled(module_info['id'], module_info['versionId'], component['componentVersion'],
+                                       self.form_key)
+        with self.lock:
+            if 'errorMessage' in resp:
+                get_metrics().inc('fill_components_total', result='error')
+                tqdm.write(
+                    f"Error on set custom field for component {component['componentName']}: {resp['errorMessage']}")
+            else:
+                if resp.get('up_to_date'):
+                    self.stats['skipped_components'] += 1
+                    get_metrics().inc('fill_components_total', result='up_to_date')
+                else:
+                    get_metrics().inc('fill_components_total', result='filled')
+            progress_bar.update()
+
+    def mark_incomplete(self):
+        if self.journal is not None:
+            self.journal.mark_incomplete()
+
+    def close(self, diff: bool = False):
+        if self.journal is not None:
+            self.journal.close()
+        if diff:
+            print(f"Writes skipped: {self.stats['skipped_components']} components already up to date")
+
+
+def get_error_answer(error: Exception) -> dict:
+    # unexpected url or answer: a failed write like the others
+    return {'errorMessage': f"{type(error).__name__}: {error}"}
+
+
+def report_fill(recorder: FillRecorder, progress_bar: tqdm, module_name: str, module_info: dict, component: dict,
+                in_flight: threading.Semaphore, future):
+    # the slot is given back whatever happens, otherwise the submitting thread waits forever
+    try:
+        try:
+            resp = future.result()
+        except Exception as e:
+            resp = get_error_answer(e)
+        recorder.record(module_name, module_info, component, resp, progress_bar)
+    finally:
+        in_flight.release()
+
+
+def fill_black_duck_form(modules: dict, headers: dict, form_values: dict,
+                         max_workers: int = MAX_WORKERS, rate: float = REQUESTS_PER_SECOND, bom_cache: BomCache = None,
+                         state: StateStore = None, diff: bool = False, journal: FillJournal = None,
+                         components_batch: dict = None):
+    """With state, the components already filled with form_values by a previous run are skipped.
+    With diff, the current values are read from Black Duck and only the components with a differing field are written.
+    With journal, the components written before an interruption are skipped and the failed writes
+    are saved in its retry batch; the journal is closed at the end of the fill.
+    components_batch (module_name -> components) fills only these components, without reading the BOM.
+    """
+    recorder = FillRecorder(form_values, state, journal)
+    rate_limiter = RateLimiter(rate, capacity=BURST)
+    in_flight = threading.Semaphore(max_workers * QUEUED_PER_WORKER)
+    progress_bars = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            module_names = list(modules)
+            streams = {}
+            for position, module_name in enumerate(module_names):
+                if components_batch is None:
+                    # only the next modules are read ahead: with a BOM cache each one holds its whole BOM
+                    for next_name in module_names[position:position + PREFETCHED_MODULES + 1]:
+                        if next_name not in streams:
+                            streams[next_name] = executor.submit(get_components, headers, modules[next_name],
+                                                                 bom_cache)
+                module_info = modules[module_name]
+                filled = recorder.get_filled(module_info)
+                skipped = dict.fromkeys(FillRecorder.SKIPPED_MESSAGES, 0)
+                try:
+                    if components_batch is None:
+                        components = streams.pop(module_name).result()
+                    else:
+                        components = components_batch[module_name]
+                    progress_bar = tqdm(
+                        total=len(components),
+                        desc=module_name.ljust(15),
+                        bar_format="{l_bar}{bar:50}{r_bar}{bar:-50b}",
+                        position=position,
+                        ascii=True)
+                    progress_bars.append(progress_bar)
+                    for component in components:
+                        reason = recorder.get_skip_reason(filled, module_info, component)
+                        if reason is not None:
+                            skipped[reason] += 1
+                            with recorder.lock:
+                                progress_bar.update()
+                            continue
+                        in_flight.acquire()
+                        future = executor.submit(
+                            fill_component, headers, module_info, component, form_values, rate_limiter, diff)
+                        future.add_done_callback(
+                            partial(report_fill, recorder, progress_bar, module_name, module_info, component,
+                                    in_flight))
+                except BlackDuckError as e:
+                    recorder.mark_incomplete()
                     print(
-                        f"Error on set custom field for component {component['componentName']}: {resp['errorMessage']}")
-                time.sleep(0.5)
+                        f"Error on get components for {module_name}: {e}")
+                recorder.report_skipped(module_name, skipped)
+    except BaseException:
+        # network error, Ctrl-C...: the writes already sent are in the journal, the next fill resumes
+        recorder.mark_incomplete()
+        raise
+    finally:
+        for progress_bar in progress_bars:
+            progress_bar.close()
+        recorder.close(diff)
+
+
+def retry_failed_fills(modules: dict, headers: dict, form_values: dict, journal: bool = True, **fill_options):
+    """Fills again only the components whose write failed in the last fill of modules (the retry batch of the journal).
+
+    Without journal the batch is sent as it is and left in place.
+    """
+    failed_modules, components_batch = load_retry_batch(modules)
+    if not failed_modules:
+        print("No failed writes to retry")
+        return
+    # the journal of the retry is the one of the fill that failed, keyed by all its modules
+    fill_black_duck_form(failed_modules, headers, form_values,
+                         journal=FillJournal(form_values, modules, retry=True) if journal else None,
+                         components_batch=components_batch, **fill_options)
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from state_store import get_form_key
+
+WORKSPACE_OCC_DIR = os.path.join(os.getcwd(), 'oss')
+# custom fields written by a fill that did not finish, one file per set of modules (see get_modules_key)
+FILL_JOURNAL_PATH = os.path.join(WORKSPACE_OCC_DIR, 'fill_journal_{modules_key}.jsonl')
+# writes failed during the last fill of the same modules, sent again with FILL_RETRY
+FILL_RETRY_PATH = os.path.join(WORKSPACE_OCC_DIR, 'fill_retry_{modules_key}.json')
+# seconds between two fsync of the journal (every line is flushed at once)
+FSYNC_INTERVAL = 1.0
+# a journal not written for this many seconds is from a fill abandoned long ago: the next fill starts over
+JOURNAL_MAX_AGE = 7 * 24 * 60 * 60
+
+
+def get_modules_key(modules: dict) -> str:
+    """Short hash of the project versions of a fill: fills of other modules keep their own journal and retry batch."""
+    versions = sorted((module_info['id'], module_info['versionId']) for module_info in modules.values())
+    return hashlib.sha1(json.dumps(versions).encode()).hexdigest()[:12]
+
+
+def get_journal_path(modules: dict) -> str:
+    return FILL_JOURNAL_PATH.format(modules_key=get_modules_key(modules))
+
+
+def get_retry_path(modules: dict) -> str:
+    return FILL_RETRY_PATH.format(modules_key=get_modules_key(modules))
+
+
+class FillJournal:
+    """Checkpoint of a fill: the writes done are appended to a JSONL file, so a fill that dies
+    (network error, expired token, Ctrl-C) resumes from where it stopped instead of component zero.
+
+    A line is flushed as soon as the write succeeds (it survives the end of the process) and
+    the file is fsync'ed every FSYNC_INTERVAL seconds and when closed (it survives a crash of the
+    machine). Only the lines written with the same form values are resumed.
+    Journal and retry batch belong to the modules of the fill: a fill of other modules does not
+    touch them.
+    The failed writes are collected and saved in the retry batch when closed (the batch of the
+    previous fill is removed when there are none). The journal is removed when the fill reaches
+    the end, failures or not, so the next fill starts from the beginning; a retry removes it only
+    if the fill that failed reached the end, and an interrupted retry keeps the batch. A journal
+    older than JOURNAL_MAX_AGE is not resumed.
+    """
+
+    def __init__(self, form_values: dict, modules: dict, retry: bool = False):
+        self.form_key = get_form_key(form_values)
+        self.retry = retry
+        self.file_path = get_journal_path(modules)
+        self.retry_path = get_retry_path(modules)
+        self.lock = threading.Lock()
+        self.done = self.load()
+        self.failures = []
+        # True when the fill stopped before the end or a module could not be read
+        self.interrupted = False
+        # retry: the fill that failed the writes of the batch did not reach the end either
+        self.pending = retry and read_retry_file(self.retry_path).get("interrupted", True)
+        self.file = open(self.file_path, 'a')
+        self.synced = time.monotonic()
+
+    @staticmethod
+    def get_key(module_info: dict, component: dict) -> tuple:
+        return module_info['id'], module_info['versionId'], component['componentVersion']
+
+    def load(self) -> set:
+        done = set()
+        if not os.path.exists(self.file_path):
+            return done
+        if time.time() - os.path.getmtime(self.file_path) > JOURNAL_MAX_AGE:
+            print(f"{self.file_path} is older than {JOURNAL_MAX_AGE // (24 * 60 * 60)} days, the fill starts over")
+            os.remove(self.file_path)
+            return done
+        with open(self.file_path) as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line cut by the end of the process
+                    continue
+                if entry["form"] == self.form_key:
+                    done.add((entry["project"], entry["version"], entry["component_version"]))
+        return done
+
+    def is_done(self, module_info: dict, component: dict) -> bool:
+        return self.get_key(module_info, component) in self.done
+
+    def record(self, module_info: dict, component: dict):
+        """The custom fields of the component are written."""
+        line = json.dumps({
+            "project": module_info['id'],
+            "version": module_info['versionId'],
+            "component": component['componentName'],
+            "component_version": component['componentVersion'],
+            "form": self.form_key
+        })
+        with self.lock:
+            self.done.add(self.get_key(module_info, component))
+            self.file.write(line + '\n')
+            self.file.flush()
+            if time.monotonic() - self.synced >= FSYNC_INTERVAL:
+                os.fsync(self.file.fileno())
+                self.synced = time.monotonic()
+
+    def add_failure(self, module_name: str, module_info: dict, component: dict, error: str):
+        with self.lock:
+            self.failures.append({
+                "module": module_name,
+                "project": module_info['id'],
+                "version": module_info['versionId'],
+                "component": component['componentName'],
+                "component_version": component['componentVersion'],
+                "error": error
+            })
+
+    def mark_incomplete(self):
+        self.interrupted = True
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        if self.retry and self.interrupted:
+            # the next retry sends the batch again, skipping the writes of the journal
+            return
+        if self.failures:
+            tmp_path = self.retry_path + '.tmp'
+            with open(tmp_path, 'w') as retry_file:
+                json.dump({"interrupted": self.interrupted or self.pending, "failures": self.failures}, retry_file,
+                          indent=4)
+            os.replace(tmp_path, self.retry_path)
+            print(f"{len(self.failures)} writes failed, saved in {self.retry_path}: "
+                  f"set FILL_RETRY to send only them")
+        elif os.path.exists(self.retry_path):
+            os.remove(self.retry_path)
+        # failures or not, the fill reached the end: the writes to do again are in the retry batch
+        if not (self.interrupted or self.pending) and os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+
+def read_retry_file(retry_path: str) -> dict:
+    if not os.path.exists(retry_path):
+        return {}
+    with open(retry_path) as retry_file:
+        return json.load(retry_file)
+
+
+def load_retry_batch(modules: dict):
+    """modules and components (module_name -> list) of the writes failed in the last fill of modules, to fill again."""
+    failed_modules, components = {}, {}
+    for failure in read_retry_file(get_retry_path(modules)).get("failures", []):
+        failed_modules[failure["module"]] = {"id": failure["project"], "versionId": failure["version"]}
+        components.setdefault(failure["module"], []).append(
+            {"componentName": failure["component"], "componentVersion": failure["component_version"]})
+    return failed_modules, components
@@ -0,0 +1,180 @@
+from collections import namedtuple
+from functools import lru_cache
+from metrics import get_metrics
+
+ALL_APPROVE = "AllApprove"
+
+# nodes of a parsed license expression
+License = namedtuple('License', ['name'])
+And = namedtuple('And', ['children'])
+Or = namedtuple('Or', ['children'])
+
+OPERATORS = (" AND ", " OR ")
+
+
+class LicenseExpressionError(ValueError):
+    pass
+
+
+def get_operator(expression: str, position: int):
+    return next((operator for operator in OPERATORS if expression.startswith(operator, position)), None)
+
+
+def tokenize(expression: str) -> list:
+    """"(", ")", "AND", "OR" and license names.
+
+    "(" groups only where an operand starts: the parentheses inside a name, as in
+    "GPL 2.0 (with exception)", belong to the name.
+    """
+    tokens = []
+    position = 0
+    # True where an operand (a name or a group) is expected, False after it
+    operand = True
+    while position < len(expression):
+        char = expression[position]
+        if not operand:
+            operator = get_operator(expression, position)
+            if operator is not None:
+                tokens.append(operator.strip())
+                position += len(operator)
+                operand = True
+            elif char == ")":
+                tokens.append(char)
+                position += 1
+            elif char == " ":
+                position += 1
+            else:
+                raise LicenseExpressionError(f"unexpected {expression[position:]!r}")
+        elif char == " ":
+            position += 1
+        elif char in "()":
+            # ")" here is an error, reported by the parser
+            tokens.append(char)
+            position += 1
+        else:
+            # the name ends at an operator or at the ")" of its group, its own parentheses included
+            start = position
+            depth = 0
+            while position < len(expression):
+                char = expression[position]
+                if depth == 0 and (char == ")" or get_operator(expression, position) is not None):
+                    break
+                if char == "(":
+                    depth += 1
+                elif char == ")":
+                    depth -= 1
+                position += 1
+            tokens.append(expression[start:position].strip())
+            operand = False
+    return tokens
+
+
+class Parser:
+    """Recursive descent parser: OR has lower precedence than AND, parentheses group."""
+
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise LicenseExpressionError(f"unexpected {self.peek()!r}")
+        return node
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek() == "OR":
+            self.next()
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else Or(tuple(children))
+
+    def parse_and(self):
+        children = [self.parse_operand()]
+        while self.peek() == "AND":
+            self.next()
+            children.append(self.parse_operand())
+        return children[0] if len(children) == 1 else And(tuple(children))
+
+    def parse_operand(self):
+        token = self.next()
+        if token == "(":
+            node = self.parse_or()
+            if self.next() != ")":
+                raise LicenseExpressionError("missing )")
+            return node
+        if token in (None, ")", "AND", "OR"):
+            raise LicenseExpressionError(f"unexpected {token!r}")
+        return License(token)
+
+
+@lru_cache(maxsize=None)
+def parse_license_expression(expression: str):
+    """AST of a license expression, parsed once per distinct expression.
+
+    A string that is not a valid expression (e.g. unbalanced parentheses) is split as before the
+    parser: on AND if present, otherwise on OR, otherwise it is a single license.
+    """
+    try:
+        return Parser(tokenize(expression)).parse()
+    except LicenseExpressionError:
+        for operator, node_type in ((" AND ", And), (" OR ", Or)):
+            if operator in expression:
+                return node_type(tuple(License(name.strip()) for name in expression.split(operator)))
+        return License(expression.strip())
+
+
+get_metrics().register_lru_cache('license_expression', parse_license_expression)
+
+
+def strip_outer_parentheses(expression: str) -> str:
+    """Removes the parentheses around the whole expression, not the ones of "(A) OR (B)"."""
+    while expression.startswith("(") and expression.endswith(")"):
+        depth = 0
+        for index, char in enumerate(expression):
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            if depth == 0 and index < len(expression) - 1:
+                # the first parenthesis is closed before the end
+                return expression
+        expression = expression[1:-1]
+    return expression
+
+
+def format_rule_set(node_rule_set: str, operator: str) -> str:
+    # a nested expression with another operator keeps its parentheses
+    other = " OR " if operator == " AND " else " AND "
+    return f"({node_rule_set})" if other in node_rule_set else node_rule_set
+
+
+def evaluate_rule_set(node, get_rule_set) -> str:
+    """Rule set of an expression; get_rule_set gives the rule set of a single license.
+
+    - licenses in OR: AllApprove if at least one of them is AllApprove
+    - licenses in AND: the AllApprove ones do not add anything and are removed
+    - the same rule set repeated is kept once
+    """
+    if isinstance(node, License):
+        return get_rule_set(node.name)
+
+    rule_sets = list(dict.fromkeys(evaluate_rule_set(child, get_rule_set) for child in node.children))
+    if isinstance(node, Or):
+        if ALL_APPROVE in rule_sets:
+            return ALL_APPROVE
+        operator = " OR "
+    else:
+        rule_sets = [rule_set for rule_set in rule_sets if rule_set != ALL_APPROVE] or [ALL_APPROVE]
+        operator = " AND "
+    if len(rule_sets) == 1:
+        return rule_sets[0]
+    return operator.join(format_rule_set(rule_set, operator) for rule_set in rule_sets)
@@ -0,0 +1,128 @@
+import os
+import json
+from datetime import datetime
+from records import LicenseRecord
+
+WORKSPACE_OCC_DIR = os.path.join(os.getcwd(), 'oss')
+# result of the licenses analysis, read by the components analysis
+LICENSES_FILE_PATH = os.path.join(WORKSPACE_OCC_DIR, 'licenses_to_check.json')
+LICENSES_NDJSON_PATH = os.path.join(WORKSPACE_OCC_DIR, 'licenses_to_check.ndjson')
+ALL_LICENSES = "All"
+# compact json, without spaces
+SEPARATORS = (',', ':')
+
+
+class LicensesAggregator:
+    """Merges the licenses of every module into the "All" view while the modules are analyzed.
+
+    The licenses of a module are written to the file as soon as the module is added and are not
+    kept: only "All" (without components, with the modules using each license) stays in memory
+    and is written at the end by close().
+
+    - json: {"<module>": {"<license>": {...}}, ..., "All": {"<license>": {...}}}
+    - ndjson: a line {"module": ..., "license": ..., "spdx_id": ..., ...} per license of every
+      module, the "All" lines last
+    The file is written aside and replaces the previous one only when closed.
+    """
+
+    def __init__(self, ndjson: bool = False, file_path: str = None):
+        self.ndjson = ndjson
+        self.file_path = file_path or (LICENSES_NDJSON_PATH if ndjson else LICENSES_FILE_PATH)
+        self.tmp_path = self.file_path + '.tmp'
+        self.file = None
+        self.all_licenses = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write_licenses(self, module_name: str, licenses: dict, with_components: bool = True):
+        if self.file is None:
+            self.file = open(self.tmp_path, 'w')
+            if not self.ndjson:
+                self.file.write('{')
+        elif not self.ndjson:
+            self.file.write(',')
+        if self.ndjson:
+            for license, value in licenses.items():
+                line = {"module": module_name, "license": license, **value.to_dict(with_components)}
+                self.file.write(json.dumps(line, separators=SEPARATORS) + '\n')
+        else:
+            module_licenses = {license: value.to_dict(with_components) for license, value in licenses.items()}
+            self.file.write(f'{json.dumps(module_name)}:{json.dumps(module_licenses, separators=SEPARATORS)}')
+
+    def add_module(self, module_name: str, licenses: dict):
+        """Writes the licenses of a module and merges them into "All"."""
+        if not licenses:
+            return
+        self.write_licenses(module_name, licenses)
+        for license, value in licenses.items():
+            all_license = self.all_licenses.get(license)
+            if all_license is None:
+                all_license = self.all_licenses[license] = LicenseRecord(
+                    spdx_id=list(value.spdx_id), rule_set=value.rule_set, modules=[])
+            else:
+                all_license.spdx_id.extend(spdx_id for spdx_id in value.spdx_id
+                                           if spdx_id not in all_license.spdx_id)
+            all_license.modules.append(module_name)
+
+    def get_all_licenses(self) -> dict:
+        """"All" licenses ordered by name."""
+        return {license: self.all_licenses[license] for license in sorted(self.all_licenses)}
+
+    def close(self) -> dict:
+        """Writes "All" and replaces the file; returns "All" (nothing is written without licenses)."""
+        all_licenses = self.get_all_licenses()
+        if self.file is None:
+            return all_licenses
+        self.write_licenses(ALL_LICENSES, all_licenses, with_components=False)
+        if not self.ndjson:
+            self.file.write('}')
+        self.file.close()
+        self.file = None
+        os.replace(self.tmp_path, self.file_path)
+        # a single result file: the one of the other format would be older
+        other_path = LICENSES_FILE_PATH if self.ndjson else LICENSES_NDJSON_PATH
+        if self.file_path != other_path and os.path.exists(other_path):
+            os.remove(other_path)
+        return all_licenses
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.tmp_path)
+
+
+def get_licenses_file_path():
+    """Result of the last licenses analysis (json or ndjson), None if there is none."""
+    paths = [path for path in (LICENSES_FILE_PATH, LICENSES_NDJSON_PATH) if os.path.exists(path)]
+    if not paths:
+        return None
+    return max(paths, key=os.path.getmtime)
+
+
+def read_all_licenses(file_path: str = None):
+    """"All" licenses saved by the licenses analysis and when they were saved (None, None if missing)."""
+    file_path = file_path or get_licenses_file_path()
+    if file_path is None or not os.path.exists(file_path):
+        return None, None
+    all_licenses = {}
+    with open(file_path) as licenses_file:
+        if file_path.endswith('.ndjson'):
+            # the lines of the modules are skipped without parsing them
+            all_prefix = json.dumps({"module": ALL_LICENSES}, separators=SEPARATORS)[:-1] + ','
+            for line in licenses_file:
+                if line.startswith(all_prefix):
+                    value = json.loads(line)
+                    del value["module"]
+                    all_licenses[value.pop("license")] = value
+        else:
+            all_licenses = json.load(licenses_file)[ALL_LICENSES]
+    creation_timestamp = os.path.getctime(file_path)
+    return all_licenses, datetime.fromtimestamp(creation_timestamp)
@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+
+# upper bounds (seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# prefix of the metric names in the Prometheus textfile
+PROMETHEUS_PREFIX = 'oss_'
+
+
+class Histogram:
+    """Count of the observed values per bucket (value <= bound), as Prometheus histograms."""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram"):
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def get_cumulative_counts(self) -> list:
+        """(bound, number of values <= bound) of every bucket, "+Inf" last."""
+        cumulative, total = [], 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def to_dict(self) -> dict:
+        return {"count": self.count, "sum": self.sum,
+                "buckets": {str(bound): count for bound, count in self.get_cumulative_counts()}}
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Metrics:
+    """Counters and latency histograms of a run, shared by all the threads.
+
+    - stage_seconds / stage_rows_total: duration and rows of fetch, parse, normalize,
+      rule_resolution, decision and excel_write
+    - http_request_seconds, http_requests_total, http_retries_total, http_*_bytes_total:
+      every attempt of a Black Duck call
+    - cache_requests_total: hit/miss of the BOM cache, of the Rules cache and of the lru caches
+    - fill_components_total: components filled, up to date, already filled or in error
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # functions decorated with lru_cache, reported as caches
+        self.lru_caches = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            # (name, labels) -> value, labels is a sorted tuple of (name, value)
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def stage(self, stage: str, rows: int = 0):
+        """Times the block as a stage; rows known only at the end are added with add_rows."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage)
+            if rows:
+                self.add_rows(stage, rows)
+
+    def add_rows(self, stage: str, rows: int):
+        self.inc('stage_rows_total', rows, stage=stage)
+
+    def register_lru_cache(self, name: str, function):
+        self.lru_caches[name] = function
+
+    def snapshot(self) -> dict:
+        """Picklable copy, sent back by the worker processes."""
+        with self.lock:
+            return {"counters": dict(self.counters), "histograms": dict(self.histograms)}
+
+    def merge(self, snapshot: dict):
+        with self.lock:
+            for key, value in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, histogram in snapshot["histograms"].items():
+                if key in self.histograms:
+                    self.histograms[key].merge(histogram)
+                else:
+                    self.histograms[key] = histogram
+
+    def get_counters(self) -> dict:
+        """Counters, with the hits and misses of the lru caches of this process."""
+        counters = dict(self.counters)
+        for name, function in self.lru_caches.items():
+            cache_info = function.cache_info()
+            counters[('cache_requests_total', (('cache', name), ('result', 'hit')))] = cache_info.hits
+            counters[('cache_requests_total', (('cache', name), ('result', 'miss')))] = cache_info.misses
+        return counters
+
+    def get_report(self) -> dict:
+        with self.lock:
+            counters = self.get_counters()
+            histograms = dict(self.histograms)
+        finished = time.time()
+        report = {
+            "started": datetime.fromtimestamp(self.started).isoformat(),
+            "finished": datetime.fromtimestamp(finished).isoformat(),
+            "duration_seconds": finished - self.started,
+            "stages": {},
+            "http": {"requests": {}, "retries": {}, "bytes_sent": 0, "bytes_received": 0, "latency": {}},
+            "caches": {},
+            "fill": {}
+        }
+        for (name, labels), histogram in histograms.items():
+            labels = dict(labels)
+            if name == 'stage_seconds':
+                rows = counters.get(('stage_rows_total', (('stage', labels['stage']),)), 0)
+                report["stages"][labels['stage']] = {
+                    "seconds": histogram.sum,
+                    "rows": rows,
+                    "rows_per_second": rows / histogram.sum if histogram.sum else None,
+                    "latency": histogram.to_dict()
+                }
+            elif name == 'http_request_seconds':
+                report["http"]["latency"][labels['method']] = histogram.to_dict()
+        for (name, labels), value in counters.items():
+            labels = dict(labels)
+            if name == 'http_requests_total':
+                report["http"]["requests"].setdefault(labels['method'], {})[labels['status']] = value
+            elif name == 'http_retries_total':
+                report["http"]["retries"].setdefault(labels['method'], {})[labels['reason']] = value
+            elif name == 'http_request_bytes_total':
+                report["http"]["bytes_sent"] += value
+            elif name == 'http_response_bytes_total':
+                report["http"]["bytes_received"] += value
+            elif name == 'cache_requests_total':
+                report["caches"].setdefault(labels['cache'], {})[labels['result']] = value
+            elif name == 'fill_components_total':
+                report["fill"][labels['result']] = value
+        for cache in report["caches"].values():
+            total = sum(cache.values())
+            # a revalidated (304) entry is a hit too: nothing was downloaded
+            cache["hit_rate"] = (total - cache.get('miss', 0)) / total if total else None
+        return report
+
+    def get_prometheus_text(self) -> str:
+        with self.lock:
+            counters = self.get_counters()
+            histograms = dict(self.histograms)
+        lines = []
+        for metric_name in sorted({name for name, _ in counters}):
+            lines.append(f'# TYPE {PROMETHEUS_PREFIX}{metric_name} counter')
+            for (name, labels), value in sorted(counters.items()):
+                if name == metric_name:
+                    lines.append(f'{PROMETHEUS_PREFIX}{name}{format_labels(labels)} {value}')
+        for metric_name in sorted({name for name, _ in histograms}):
+            lines.append(f'# TYPE {PROMETHEUS_PREFIX}{metric_name} histogram')
+            for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+                if name != metric_name:
+                    continue
+                for bound, count in histogram.get_cumulative_counts():
+                    lines.append(
+                        f'{PROMETHEUS_PREFIX}{name}_bucket{format_labels(labels + (("le", bound),))} {count}')
+                lines.append(f'{PROMETHEUS_PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{PROMETHEUS_PREFIX}{name}_count{format_labels(labels)} {histogram.count}')
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}run_duration_seconds gauge')
+        lines.append(f'{PROMETHEUS_PREFIX}run_duration_seconds {time.time() - self.started}')
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, file_path: str):
+        """Prometheus textfile if file_path ends with .prom, JSON otherwise."""
+        if file_path.endswith('.prom'):
+            content = self.get_prometheus_text()
+        else:
+            content = json.dumps(self.get_report(), indent=4)
+        # written at once, the textfile collector never reads half a file
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'w') as report_file:
+            report_file.write(content)
+        os.replace(tmp_path, file_path)
+
+
+_metrics = Metrics()
+# a worker process can be forked while a thread of the parent holds the lock
+os.register_at_fork(after_in_child=lambda: setattr(_metrics, 'lock', threading.Lock()))
+
+
+def get_metrics() -> Metrics:
+    """Metrics of the current process."""
+    return _metrics
+
+
+def call_with_metrics(function, *args, **kwargs):
+    """(result, metrics snapshot) of function run in a worker process, merged by the caller with merge."""
+    _metrics.reset()
+    result = function(*args, **kwargs)
+    return result, _metrics.snapshot()
@@ -0,0 +1,50 @@
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from black_duck_api import BlackDuckError
+from bom_cache import BomCache, get_components
+from metrics import get_metrics, call_with_metrics
+from rules import load_rules
+
+# BOM downloaded at the same time
+FETCH_WORKERS = 8
+
+
+def fetch_components(headers: dict, bom_cache: BomCache, module_info: dict) -> list:
+    return list(get_components(headers, module_info, bom_cache))
+
+
+def analyze_modules(modules: dict, headers: dict, analyze, workers: int, bom_cache: BomCache = None,
+                    fetch_workers: int = FETCH_WORKERS):
+    """Yields (module_name, analyze(components)) for every module, in the order of modules.
+
+    The BOM are downloaded by a thread pool and each one is sent to a process pool as soon as it
+    arrives, so the analysis of a module runs while the next ones are still downloading.
+    analyze must be picklable (a module level function or a partial of it).
+    """
+    fetch = partial(fetch_components, headers, bom_cache)
+    # the workers read the Rules cache written here instead of building it all at the same time
+    load_rules()
+    with ThreadPoolExecutor(max_workers=fetch_workers) as threads, \
+            ProcessPoolExecutor(max_workers=workers) as processes:
+        fetches = {threads.submit(fetch, module_info): module_name
+                   for module_name, module_info in modules.items()}
+        analyses = {}
+        for fetch_future in as_completed(fetches):
+            module_name = fetches[fetch_future]
+            try:
+                components = fetch_future.result()
+            except BlackDuckError as e:
+                print(f"Error on get components for {module_name}: {e}")
+                continue
+            # the metrics of the worker processes come back with the result
+            analyses[module_name] = processes.submit(call_with_metrics, analyze, components)
+
+        # results are merged in the order of modules, whatever the completion order
+        for module_name in tqdm(
+                [module_name for module_name in modules if module_name in analyses],
+                desc="Modules".ljust(15),
+                bar_format="{l_bar}{bar:50}{r_bar}{bar:-50b}", ascii=True):
+            result, metrics = analyses[module_name].result()
+            get_metrics().merge(metrics)
+            yield module_name, result
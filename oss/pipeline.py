@@ -0,0 +1,23 @@
+from bom_cache import BomCache
+from state_store import StateStore
+from license_analysis import perform_license_analysis
+from components_analysis import perform_components_analysis
+from fill_forms import fill_black_duck_form
+
+
+def run_pipeline(modules: dict, headers: dict, branch_infos: dict, form_values: dict,
+                 bom_cache: BomCache = None, workers: int = 1, state: StateStore = None, licenses_ndjson: bool = False,
+                 **fill_options):
+    """Licenses, components and custom fields in a single run: the BOM of each module is downloaded once.
+
+    Without bom_cache the saved BOM are revalidated at the first read of the run (304 when
+    unchanged, no download) and reused by the next analyses of the same run only.
+    """
+    bom_cache = bom_cache or BomCache(ttl=0, revalidate=True)
+    print("Analyzing licenses...")
+    perform_license_analysis(modules, headers, bom_cache, workers, licenses_ndjson)
+    # components analysis needs licenses_to_check.json (or .ndjson), written by the licenses analysis
+    print("Analyzing components...")
+    perform_components_analysis(modules, headers, branch_infos, bom_cache, workers)
+    print("Filling custom fields...")
+    fill_black_duck_form(modules, headers, form_values, bom_cache=bom_cache, state=state, **fill_options)
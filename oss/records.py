@@ -0,0 +1,56 @@
+from enums import RiskFlag
+
+
+def get_risk_label(risk: int) -> str:
+    # same text as before: risk names separated (and followed) by a space
+    return "".join(f"{flag.name} " for flag in RiskFlag if risk & flag)
+
+
+class ComponentRecord:
+    """A row of the components analysis. __slots__ keeps it small on portfolio-wide runs."""
+
+    __slots__ = ('component', 'component_version', 'usage', 'license', 'risk', 'rule_set', 'decision')
+
+    def __init__(self, component: str, component_version: str, usage: str, license: str, risk: int = 0,
+                 rule_set: str = None, decision: str = None):
+        self.component = component
+        self.component_version = component_version
+        self.usage = usage
+        self.license = license
+        # RiskFlag bits of the risk levels with a count != 0
+        self.risk = risk
+        self.rule_set = rule_set
+        self.decision = decision
+
+    @property
+    def license_risk(self) -> str:
+        return get_risk_label(self.risk)
+
+    def to_dict(self) -> dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __repr__(self):
+        return f"ComponentRecord({self.to_dict()})"
+
+
+class LicenseRecord:
+    """A license of the licenses analysis, with the components using it (modules in "All")."""
+
+    __slots__ = ('spdx_id', 'rule_set', 'components', 'modules')
+
+    def __init__(self, spdx_id=None, rule_set: str = "", components: list = None, modules: list = None):
+        self.spdx_id = spdx_id if spdx_id is not None else []
+        self.rule_set = rule_set
+        self.components = components if components is not None else []
+        self.modules = modules
+
+    def to_dict(self, with_components: bool = True) -> dict:
+        values = {"spdx_id": list(self.spdx_id), "rule_set": self.rule_set}
+        if with_components:
+            values["components"] = self.components
+        if self.modules is not None:
+            values["modules"] = self.modules
+        return values
+
+    def __repr__(self):
+        return f"LicenseRecord({self.to_dict()})"
@@ -0,0 +1,195 @@
+import os
+import hashlib
+import pickle
+import tempfile
+from functools import lru_cache
+from license_expression import evaluate_rule_set, parse_license_expression
+from metrics import get_metrics
+
+WORKSPACE_OCC_DIR = os.path.join(os.getcwd(), 'oss')
+RULES_FILE_PATH = os.path.join(WORKSPACE_OCC_DIR, 'Rules v073.xlsx')
+# parsed Rules file, reused until the xlsx changes
+RULES_CACHE_DIR = os.path.join(WORKSPACE_OCC_DIR, '.rules_cache')
+NOT_FOUND = "NOT_FOUND"
+# sheets of the Rules file that are not rule sets
+LICENSES_SHEET = 'Licenses'
+# rule sets without a sheet
+FIXED_DECISIONS = {"AllApprove": "approve", "AllReject": "reject"}
+# rows of a rule set sheet: 24 (internal) * 2 (modification) ... see get_decision_index
+DECISION_ROWS = 48
+DECISION_FIRST_ROW = 2
+DECISION_COLUMN = 6
+
+
+def normalize_license(license_name: str) -> str:
+    # same license written with different case or spaces
+    return " ".join(license_name.split()).casefold()
+
+
+class RulesIndex:
+    """License -> rule set lookup, built once from the 'Licenses' sheet of the Rules file."""
+
+    def __init__(self, rules: dict):
+        self.rules = rules
+        # secondary index used when the exact name is not found
+        self.normalized_rules = {}
+        for license_name, rule_set in rules.items():
+            self.normalized_rules.setdefault(normalize_license(license_name), rule_set)
+
+    @classmethod
+    def from_data_frame(cls, data_frame) -> "RulesIndex":
+        import pandas as pd
+        rules = {}
+        for license_name, rule_set in zip(data_frame["License"], data_frame["Rule set"]):
+            if pd.isna(license_name) or pd.isna(rule_set):
+                continue
+            # the first row of a license wins, as the old DataFrame lookup did
+            rules.setdefault(str(license_name), str(rule_set))
+        return cls(rules)
+
+    @classmethod
+    def from_excel(cls, file_path: str = RULES_FILE_PATH) -> "RulesIndex":
+        import pandas as pd
+        return cls.from_data_frame(pd.read_excel(file_path, sheet_name='Licenses'))
+
+    def get(self, license_name: str) -> str:
+        rule_set = self.rules.get(license_name)
+        if rule_set is None:
+            rule_set = self.normalized_rules.get(normalize_license(license_name), NOT_FOUND)
+        return rule_set
+
+    def resolve(self, license_name: str) -> str:
+        """Rule set of a license expression, reduced over its AND/OR tree."""
+        return evaluate_rule_set(parse_license_expression(license_name), self.get)
+
+    def resolve_many(self, license_names) -> dict:
+        """Rule set of every distinct license expression."""
+        return {license_name: self.resolve(license_name) for license_name in dict.fromkeys(license_names)}
+
+
+def get_decision_index(branch_infos: dict, interaction_value: int) -> int:
+    """Position of the decision inside a rule set sheet (0 is the first row after the header)."""
+    index = 0
+    if not branch_infos["Internal"]:
+        index = index + 24
+
+    if not branch_infos["Modification"]:
+        index = index + 12
+
+    if not branch_infos["Hosted"]:
+        index = index + 8
+    else:
+        if not branch_infos["Host_control_ABB"]:
+            index = index + 4
+
+    return index + interaction_value
+
+
+class DecisionTable:
+    """Decisions of every rule set sheet, compiled once from the Rules file.
+
+    For each rule set the decision column is kept as a tuple indexed by get_decision_index, so a
+    decision is a dict lookup plus a tuple access instead of a cell read on the workbook.
+    """
+
+    def __init__(self, decisions: dict):
+        self.decisions = decisions
+
+    @classmethod
+    def from_excel(cls, file_path: str = RULES_FILE_PATH) -> "DecisionTable":
+        import openpyxl
+        workbook = openpyxl.load_workbook(file_path, read_only=True)
+        decisions = {}
+        for sheet_name in workbook.sheetnames:
+            if sheet_name == LICENSES_SHEET:
+                continue
+            rows = workbook[sheet_name].iter_rows(
+                min_row=DECISION_FIRST_ROW, max_row=DECISION_FIRST_ROW + DECISION_ROWS - 1,
+                min_col=DECISION_COLUMN, max_col=DECISION_COLUMN, values_only=True)
+            column = [row[0] for row in rows]
+            # short sheets: missing rows read as empty cells
+            column += [None] * (DECISION_ROWS - len(column))
+            decisions[sheet_name] = tuple(column)
+        workbook.close()
+        return cls(decisions)
+
+    def get(self, rule_set: str, decision_index: int):
+        if rule_set in FIXED_DECISIONS:
+            return FIXED_DECISIONS[rule_set]
+        column = self.decisions.get(rule_set)
+        if column is None:
+            return NOT_FOUND
+        return column[decision_index]
+
+
+def get_file_hash(file_path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def load_cached(name: str, build, file_path: str = RULES_FILE_PATH, cache_dir: str = RULES_CACHE_DIR):
+    """Object built from the Rules file, pickled in cache_dir and rebuilt only when the file changes.
+
+    The mtime is checked first; when it differs the file hash decides, so a copy or a touch of
+    the same workbook does not trigger a new parsing.
+    """
+    cache_path = os.path.join(cache_dir, f'{name}.pickle')
+    mtime = os.path.getmtime(file_path)
+    cached = None
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached = pickle.load(cache_file)
+    except (OSError, pickle.PickleError, EOFError, AttributeError, ImportError):
+        # missing or unreadable cache
+        pass
+
+    file_hash = None
+    if cached is not None:
+        if cached["mtime"] == mtime:
+            get_metrics().inc('cache_requests_total', cache=name, result='hit')
+            return cached["value"]
+        file_hash = get_file_hash(file_path)
+        if cached["hash"] == file_hash:
+            get_metrics().inc('cache_requests_total', cache=name, result='revalidated')
+            value = cached["value"]
+        else:
+            cached = None
+    if cached is None:
+        get_metrics().inc('cache_requests_total', cache=name, result='miss')
+        file_hash = file_hash or get_file_hash(file_path)
+        value = build(file_path)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # a temporary file of its own: processes building the cache at the same time do not move each other's file
+    fd, tmp_path = tempfile.mkstemp(prefix=f'{name}.', suffix='.tmp', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as cache_file:
+            pickle.dump({"mtime": mtime, "hash": file_hash, "value": value}, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return value
+
+
+@lru_cache(maxsize=None)
+def get_rules_index(file_path: str = RULES_FILE_PATH) -> RulesIndex:
+    """Rules index, loaded on first use and then shared by the whole process."""
+    return load_cached('rules_index', RulesIndex.from_excel, file_path)
+
+
+@lru_cache(maxsize=None)
+def get_decision_table(file_path: str = RULES_FILE_PATH) -> DecisionTable:
+    """Decision table, compiled on first use and cached next to the rules index."""
+    return load_cached('decision_table', DecisionTable.from_excel, file_path)
+
+
+def load_rules(file_path: str = RULES_FILE_PATH):
+    """Loads the rules index and the decision table, so the worker processes started next find the cache ready."""
+    if not os.path.exists(file_path):
+        return
+    get_rules_index(file_path)
+    get_decision_table(file_path)
@@ -0,0 +1,45 @@
+import os
+import json
+import sqlite3
+import threading
+
+# state of the previous runs
+STATE_FILE_PATH = os.path.join(os.getcwd(), 'oss', 'state.sqlite')
+
+
+def get_form_key(form_values: dict) -> str:
+    return json.dumps({field: enum.value for field, enum in form_values.items()}, sort_keys=True)
+
+
+class StateStore:
+    """SQLite store of the custom field values last written on every component version, to skip
+    the components already filled.
+    """
+
+    def __init__(self, file_path: str = STATE_FILE_PATH):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        with self.connection:
+            # components analysis results saved by older versions: recomputing them is faster than reading them
+            self.connection.execute('DROP TABLE IF EXISTS component_records')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS custom_fields (
+                project_id TEXT, version_id TEXT, component_version TEXT, form TEXT,
+                PRIMARY KEY (project_id, version_id, component_version))''')
+
+    def get_filled(self, project_id: str, version_id: str) -> dict:
+        """component version url -> form key last written."""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT component_version, form FROM custom_fields WHERE project_id = ? AND version_id = ?',
+                (project_id, version_id)).fetchall()
+        return dict(rows)
+
+    def save_filled(self, project_id: str, version_id: str, component_version: str, form_key: str):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO custom_fields VALUES (?, ?, ?, ?)',
+                (project_id, version_id, component_version, form_key))
+
+    def close(self):
+        self.connection.close()
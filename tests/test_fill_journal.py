@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import pytest
+import fill_journal
+from enums import Obligation
+from fill_journal import FillJournal, JOURNAL_MAX_AGE, get_journal_path, get_retry_path, load_retry_batch
+
+FORM_VALUES = {"22": Obligation.AGREE}
+MODULES = {"Matomo": {"id": "project-1", "versionId": "version-1"}}
+OTHER_MODULES = {"Piwik": {"id": "project-2", "versionId": "version-2"}}
+COMPONENTS = [{"componentName": f"component-{index}", "componentVersion": f"/api/components/{index}/versions/{index}"}
+              for index in range(3)]
+
+
+@pytest.fixture(autouse=True)
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.setattr(fill_journal, 'FILL_JOURNAL_PATH', str(tmp_path / 'fill_journal_{modules_key}.jsonl'))
+    monkeypatch.setattr(fill_journal, 'FILL_RETRY_PATH', str(tmp_path / 'fill_retry_{modules_key}.json'))
+
+
+def fill(journal: FillJournal, failed: tuple = (), interrupted: bool = False, modules: dict = MODULES):
+    """Writes COMPONENTS of the first module, failing the indexes in failed."""
+    module_name, module_info = next(iter(modules.items()))
+    for index, component in enumerate(COMPONENTS):
+        if journal.is_done(module_info, component):
+            continue
+        if index in failed:
+            journal.add_failure(module_name, module_info, component, "Too many requests")
+        else:
+            journal.record(module_info, component)
+    if interrupted:
+        journal.mark_incomplete()
+    journal.close()
+
+
+def read_retry(modules: dict = MODULES) -> dict:
+    with open(get_retry_path(modules)) as retry_file:
+        return json.load(retry_file)
+
+
+def test_interrupted_fill_resumes():
+    fill(FillJournal(FORM_VALUES, MODULES), interrupted=True)
+    assert os.path.exists(get_journal_path(MODULES))
+    journal = FillJournal(FORM_VALUES, MODULES)
+    assert all(journal.is_done(MODULES["Matomo"], component) for component in COMPONENTS)
+    journal.close()
+
+
+def test_other_form_values_are_not_resumed():
+    fill(FillJournal(FORM_VALUES, MODULES), interrupted=True)
+    journal = FillJournal({"22": Obligation.DISAGREE}, MODULES)
+    assert not journal.is_done(MODULES["Matomo"], COMPONENTS[0])
+    journal.close()
+
+
+def test_old_journal_is_not_resumed():
+    fill(FillJournal(FORM_VALUES, MODULES), interrupted=True)
+    old = time.time() - JOURNAL_MAX_AGE - 60
+    os.utime(get_journal_path(MODULES), (old, old))
+    journal = FillJournal(FORM_VALUES, MODULES)
+    assert not journal.is_done(MODULES["Matomo"], COMPONENTS[0])
+    journal.close()
+
+
+def test_completed_fill_keeps_only_the_failures():
+    fill(FillJournal(FORM_VALUES, MODULES), failed=(1,))
+    assert not os.path.exists(get_journal_path(MODULES))
+    retry = read_retry()
+    assert retry["interrupted"] is False
+    assert [failure["component"] for failure in retry["failures"]] == ["component-1"]
+    modules, components = load_retry_batch(MODULES)
+    assert modules == MODULES
+    assert components == {"Matomo": [{"componentName": "component-1",
+                                      "componentVersion": COMPONENTS[1]["componentVersion"]}]}
+
+
+def test_completed_fill_without_failures_removes_the_retry_batch():
+    fill(FillJournal(FORM_VALUES, MODULES), failed=(1,))
+    fill(FillJournal(FORM_VALUES, MODULES))
+    assert not os.path.exists(get_retry_path(MODULES))
+    assert not os.path.exists(get_journal_path(MODULES))
+
+
+def test_interrupted_fill_keeps_journal_and_failures():
+    fill(FillJournal(FORM_VALUES, MODULES), failed=(1,), interrupted=True)
+    assert os.path.exists(get_journal_path(MODULES))
+    assert read_retry()["interrupted"] is True
+
+
+def test_successful_retry_removes_the_batch():
+    fill(FillJournal(FORM_VALUES, MODULES), failed=(1,))
+    fill(FillJournal(FORM_VALUES, MODULES, retry=True))
+    assert not os.path.exists(get_retry_path(MODULES))
+    assert not os.path.exists(get_journal_path(MODULES))
+
+
+def test_interrupted_retry_keeps_the_batch():
+    fill(FillJournal(FORM_VALUES, MODULES), failed=(1, 2))
+    fill(FillJournal(FORM_VALUES, MODULES, retry=True), failed=(2,), interrupted=True)
+    assert [failure["component"] for failure in read_retry()["failures"]] == ["component-1", "component-2"]
+    # the writes of the interrupted retry are skipped by the next one
+    journal = FillJournal(FORM_VALUES, MODULES, retry=True)
+    assert journal.is_done(MODULES["Matomo"], COMPONENTS[1])
+    assert not journal.is_done(MODULES["Matomo"], COMPONENTS[2])
+    journal.close()
+
+
+def test_retry_of_an_interrupted_fill_keeps_its_journal():
+    fill(FillJournal(FORM_VALUES, MODULES), failed=(1,), interrupted=True)
+    fill(FillJournal(FORM_VALUES, MODULES, retry=True))
+    assert not os.path.exists(get_retry_path(MODULES))
+    # the fill that failed did not reach the end: the next fill resumes it
+    assert os.path.exists(get_journal_path(MODULES))
+
+
+def test_fills_of_other_modules_do_not_touch_the_files():
+    fill(FillJournal(FORM_VALUES, MODULES), failed=(1,), interrupted=True)
+    fill(FillJournal(FORM_VALUES, OTHER_MODULES), modules=OTHER_MODULES)
+    assert os.path.exists(get_journal_path(MODULES))
+    assert read_retry()["failures"]
+    assert load_retry_batch(OTHER_MODULES) == ({}, {})
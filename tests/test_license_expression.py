@@ -0,0 +1,86 @@
+import pytest
+from license_expression import (License, And, Or, LicenseExpressionError, tokenize, parse_license_expression,
+                                evaluate_rule_set, strip_outer_parentheses)
+
+RULE_SETS = {
+    "MIT": "AllApprove",
+    "BSD 3-clause": "AllApprove",
+    "Apache 2.0": "Permissive",
+    "GPL 2.0": "Copyleft",
+    "GPL 2.0 (with exception)": "Copyleft",
+    "LGPL 2.1": "WeakCopyleft",
+}
+
+
+def resolve(expression: str) -> str:
+    return evaluate_rule_set(parse_license_expression(expression), lambda name: RULE_SETS.get(name, "NOT_FOUND"))
+
+
+def test_tokenize_keeps_parentheses_inside_names():
+    assert tokenize("(MIT OR GPL 2.0 (with exception))") == ["(", "MIT", "OR", "GPL 2.0 (with exception)", ")"]
+
+
+def test_tokenize_rejects_text_after_an_operand():
+    with pytest.raises(LicenseExpressionError):
+        tokenize("(MIT) Apache 2.0")
+
+
+@pytest.mark.parametrize("expression, tree", [
+    ("MIT", License("MIT")),
+    ("MIT AND Apache 2.0", And((License("MIT"), License("Apache 2.0")))),
+    # AND binds tighter than OR
+    ("MIT OR Apache 2.0 AND GPL 2.0", Or((License("MIT"), And((License("Apache 2.0"), License("GPL 2.0")))))),
+    ("MIT AND Apache 2.0 OR GPL 2.0", Or((And((License("MIT"), License("Apache 2.0"))), License("GPL 2.0")))),
+    ("(MIT OR Apache 2.0) AND GPL 2.0", And((Or((License("MIT"), License("Apache 2.0"))), License("GPL 2.0")))),
+    ("((MIT AND (Apache 2.0 OR LGPL 2.1)))",
+     And((License("MIT"), Or((License("Apache 2.0"), License("LGPL 2.1")))))),
+    ("MIT OR GPL 2.0 (with exception)", Or((License("MIT"), License("GPL 2.0 (with exception)")))),
+    ("(Apache 2.0 AND GPL 2.0 (with exception))", And((License("Apache 2.0"), License("GPL 2.0 (with exception)")))),
+    ("GPL 2.0 (with exception)", License("GPL 2.0 (with exception)")),
+])
+def test_parse(expression, tree):
+    assert parse_license_expression(expression) == tree
+
+
+@pytest.mark.parametrize("expression, tree", [
+    # unbalanced parentheses: split on AND first, then on OR, as before the parser
+    ("(MIT AND Apache 2.0 OR GPL 2.0", And((License("(MIT"), License("Apache 2.0 OR GPL 2.0")))),
+    ("MIT) OR Apache 2.0", Or((License("MIT)"), License("Apache 2.0")))),
+    ("MIT) Apache 2.0", License("MIT) Apache 2.0")),
+    ("MIT AND", License("MIT AND")),
+])
+def test_parse_falls_back_to_the_old_split(expression, tree):
+    assert parse_license_expression(expression) == tree
+
+
+@pytest.mark.parametrize("expression, rule_set", [
+    ("Apache 2.0", "Permissive"),
+    ("Unknown", "NOT_FOUND"),
+    # OR: one AllApprove license is enough
+    ("MIT OR GPL 2.0", "AllApprove"),
+    ("MIT OR GPL 2.0 (with exception)", "AllApprove"),
+    # AND: the AllApprove licenses do not add anything
+    ("MIT AND GPL 2.0", "Copyleft"),
+    ("MIT AND BSD 3-clause", "AllApprove"),
+    ("(Apache 2.0 AND GPL 2.0 (with exception))", "Permissive AND Copyleft"),
+    # the same rule set is kept once
+    ("GPL 2.0 AND GPL 2.0 (with exception)", "Copyleft"),
+    ("Apache 2.0 OR GPL 2.0", "Permissive OR Copyleft"),
+    # nested expressions with the other operator keep their parentheses
+    ("Apache 2.0 AND (GPL 2.0 OR LGPL 2.1)", "Permissive AND (Copyleft OR WeakCopyleft)"),
+    ("Apache 2.0 OR GPL 2.0 AND LGPL 2.1", "Permissive OR (Copyleft AND WeakCopyleft)"),
+    ("(MIT OR GPL 2.0) AND LGPL 2.1", "WeakCopyleft"),
+    ("(MIT AND GPL 2.0) OR (MIT AND LGPL 2.1)", "Copyleft OR WeakCopyleft"),
+])
+def test_evaluate_rule_set(expression, rule_set):
+    assert resolve(expression) == rule_set
+
+
+@pytest.mark.parametrize("expression, stripped", [
+    ("(MIT AND Apache 2.0)", "MIT AND Apache 2.0"),
+    ("((MIT))", "MIT"),
+    ("(MIT) OR (Apache 2.0)", "(MIT) OR (Apache 2.0)"),
+    ("GPL 2.0 (with exception)", "GPL 2.0 (with exception)"),
+])
+def test_strip_outer_parentheses(expression, stripped):
+    assert strip_outer_parentheses(expression) == stripped